@@ -0,0 +1,96 @@
+import os, queue, threading, cv2, modules.globals
+from typing import Any, List, Tuple
+from tqdm import tqdm
+from modules.events import watch_progress
+from modules.frame_ring import get_frame_chain
+from modules.memory import GOVERNOR
+from modules.predicter import predict_frame
+from modules.utilities import get_image_paths
+
+# Threads decoding and encoding images around the processing threads
+BATCH_DECODE_WORKERS = 2
+BATCH_ENCODE_WORKERS = 2
+
+
+def process_image_directory(source_path: str, target_directory: str, output_directory: str) -> Tuple[int, int]:
+    """Decodes, processes and encodes every image of the directory in parallel stages, returns the processed and total count."""
+    image_paths = get_image_paths(target_directory)
+    os.makedirs(output_directory, exist_ok=True)
+    # the source face and the models are loaded once for the whole batch
+    process_frame = get_frame_chain(source_path)
+    worker_total = modules.globals.execution_threads
+    path_queue: queue.Queue = queue.Queue()
+    work_queue: queue.Queue = queue.Queue(maxsize=2 * worker_total)
+    encode_queue: queue.Queue = queue.Queue(maxsize=2 * worker_total)
+    results = {'processed': 0}
+    results_lock = threading.Lock()
+    for image_path in image_paths:
+        path_queue.put(image_path)
+
+    def finish(progress: Any, processed: bool) -> None:
+        if processed:
+            with results_lock:
+                results['processed'] += 1
+        progress.update(1)
+
+    def decode(progress: Any) -> None:
+        while True:
+            try:
+                image_path = path_queue.get_nowait()
+            except queue.Empty:
+                return
+            frame = cv2.imread(image_path)
+            # the decoded BGR frame is screened as is, prepare_frame converts it to the RGB the model expects
+            if frame is None or (modules.globals.nsfw_filter and predict_frame(frame)):
+                finish(progress, False)
+                continue
+            GOVERNOR.enter()
+            work_queue.put((image_path, frame))
+
+    def work() -> None:
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            image_path, frame = item
+            try:
+                frame = process_frame(frame)
+            except Exception as exception:
+                print(f'{image_path}: {exception}')
+                frame = None
+            encode_queue.put((image_path, frame))
+
+    def encode(progress: Any) -> None:
+        while True:
+            item = encode_queue.get()
+            if item is None:
+                return
+            image_path, frame = item
+            processed = frame is not None and cv2.imwrite(os.path.join(output_directory, os.path.basename(image_path)), frame)
+            GOVERNOR.leave()
+            finish(progress, processed)
+
+    def run_stage(target: Any, thread_total: int, *args: Any) -> List[threading.Thread]:
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(thread_total)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    with tqdm(total=len(image_paths), desc='Processing', unit='image', dynamic_ncols=True) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers,
+                              'execution_threads': worker_total})
+        watch_progress(progress)
+        decoders = run_stage(decode, BATCH_DECODE_WORKERS, progress)
+        workers = run_stage(work, worker_total)
+        encoders = run_stage(encode, BATCH_ENCODE_WORKERS, progress)
+        for thread in decoders:
+            thread.join()
+        for _ in workers:
+            work_queue.put(None)
+        for thread in workers:
+            thread.join()
+        for _ in encoders:
+            encode_queue.put(None)
+        for thread in encoders:
+            thread.join()
+    return results['processed'], len(image_paths)
@@ -0,0 +1,106 @@
+import gc, sys, threading, time, tracemalloc, cv2, numpy as np, psutil
+from typing import Any, Callable, Dict, List, Tuple
+from modules.memory import register_release
+from modules.typing import Frame
+
+# Buffers kept per shape and dtype, frames needed beyond that are allocated and dropped as before
+MAX_POOLED_BUFFERS = 8
+
+
+def get_free_refcount() -> int:
+    """Returns the reference count of a buffer only the pool holds, as seen from inside the pool."""
+    buffers = [np.empty(0)]
+    return sys.getrefcount(buffers[0])
+
+
+FREE_REFCOUNT = get_free_refcount()
+
+
+class BufferPool:
+    """Hands out preallocated arrays keyed by shape and dtype, a buffer is reused once nothing references it anymore."""
+
+    def __init__(self) -> None:
+        self.buffers: Dict[Tuple[Tuple[int, ...], str], List[np.ndarray]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, shape: Tuple[int, ...], dtype: Any = np.uint8) -> np.ndarray:
+        """Returns an uninitialized array, views and frames handed to other threads keep their buffer out of the pool."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            buffers = self.buffers.setdefault(key, [])
+            for index in range(len(buffers)):
+                if sys.getrefcount(buffers[index]) <= FREE_REFCOUNT:
+                    return buffers[index]
+            buffer = np.empty(shape, dtype=dtype)
+            if len(buffers) < MAX_POOLED_BUFFERS:
+                buffers.append(buffer)
+            return buffer
+
+    def like(self, array: np.ndarray) -> np.ndarray:
+        return self.get(array.shape, array.dtype)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.buffers.clear()
+
+
+BUFFER_POOL = BufferPool()
+register_release(BUFFER_POOL.clear)
+
+
+def prepare_live_frame(frame: Frame, size: Tuple[int, int], pool: BufferPool = None) -> bytes:
+    """Mirrors, resizes and converts a frame for display like the live loop does, into pooled buffers when a pool is given."""
+    mirrored = cv2.flip(frame, 1, dst=pool.like(frame) if pool else None)
+    resized = cv2.resize(mirrored, size, dst=pool.get((size[1], size[0], 3)) if pool else None)
+    rgb_frame = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=pool.like(resized) if pool else None)
+    return f'P6 {size[0]} {size[1]} 255 '.encode() + memoryview(rgb_frame)
+
+
+def measure(step: Callable[[], Any], count: int) -> Dict[str, float]:
+    """Runs the step and reports its allocation rate, garbage collections and resident memory churn."""
+    collections = [0]
+
+    def on_collect(phase: str, info: Dict[str, int]) -> None:
+        if phase == 'start':
+            collections[0] += 1
+
+    process = psutil.Process()
+    allocated, rss_churn = 0, 0
+    step()
+    gc.callbacks.append(on_collect)
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        for _ in range(count):
+            rss = process.memory_info().rss
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            step()
+            # the intermediate arrays live until the step returns, so the peak is what it allocated
+            allocated += tracemalloc.get_traced_memory()[1] - current
+            rss_churn += abs(process.memory_info().rss - rss)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        tracemalloc.stop()
+        gc.callbacks.remove(on_collect)
+    return {'fps': count / elapsed, 'allocated_per_frame': allocated / count, 'allocation_rate': allocated / elapsed,
+            'gc_collections': collections[0], 'rss_churn_per_frame': rss_churn / count}
+
+
+def benchmark(frame: Frame, size: Tuple[int, int], count: int = 200) -> Dict[str, Dict[str, float]]:
+    """Compares preparing live frames with fresh arrays against preparing them in pooled buffers."""
+    pool = BufferPool()
+    return {
+        'allocating': measure(lambda: prepare_live_frame(frame, size), count),
+        'pooled': measure(lambda: prepare_live_frame(frame, size, pool), count)
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python -m modules.buffer_pool <image> [count]')
+        sys.exit(1)
+    image = cv2.imread(sys.argv[1])
+    for name, result in benchmark(image, (image.shape[1] * 3 // 4, image.shape[0] * 3 // 4), int(sys.argv[2]) if len(sys.argv) > 2 else 200).items():
+        print(f"{name:>10}: {result['fps']:7.1f} fps  {result['allocated_per_frame'] / 1024 ** 2:6.2f} MB/frame  {result['allocation_rate'] / 1024 ** 3:6.2f} GB/s allocated"
+              f"  {result['gc_collections']:4d} gc  {result['rss_churn_per_frame'] / 1024 ** 2:6.2f} MB/frame rss churn")
@@ -1,23 +1,144 @@
-import cv2, modules.globals
-from typing import Any
+import bisect, threading, cv2, numpy as np, modules.globals
+from collections import OrderedDict
+from typing import Any, Hashable, List
+from modules.buffer_pool import BUFFER_POOL
+from modules.memory import register_release
+from modules.probe import probe
+from modules.utilities import detect_keyframes
 
-def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
-    capture = cv2.VideoCapture(video_path)
-    capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+# Number of decoded frames kept by the video reader
+DECODED_CACHE_SIZE = 16
 
-    if modules.globals.color_correction:
-        capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
 
-    capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    has_frame, frame = capture.read()
+class FrameCache:
+    """Least recently used cache of frames, cleared when its configuration changes."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.frames: OrderedDict = OrderedDict()
+        self.config: Hashable = None
+        self.lock = threading.Lock()
+
+    def validate(self, config: Hashable) -> None:
+        with self.lock:
+            if config != self.config:
+                self.frames.clear()
+                self.config = config
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            if key not in self.frames:
+                return None
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+    def put(self, key: Hashable, frame: Any) -> None:
+        with self.lock:
+            self.frames[key] = frame
+            self.frames.move_to_end(key)
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+
+    def clear(self) -> None:
+        self.validate(None)
+
+
+class VideoReader:
+    """Keeps a video open for random access, seeking to the preceding keyframe and decoding forward."""
+
+    def __init__(self, video_path: str) -> None:
+        self.video_path = video_path
+        self.capture = cv2.VideoCapture(video_path)
+        self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        self.position = 0
+        self.frames = FrameCache(DECODED_CACHE_SIZE)
+        self.lock = threading.Lock()
+        try:
+            self.keyframes: List[int] = detect_keyframes(video_path)[0][:-1]
+        except Exception:
+            self.keyframes = []
+
+    def get_keyframe(self, frame_number: int) -> int:
+        """Returns the last keyframe at or before the frame, -1 when the keyframes are unknown."""
+        index = bisect.bisect_right(self.keyframes, frame_number) - 1
+        return self.keyframes[index] if index >= 0 else -1
+
+    def seek(self, frame_number: int) -> None:
+        keyframe = self.get_keyframe(frame_number)
+        if keyframe < 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            self.position = frame_number
+            return
+        # decoding forward is cheaper than a seek as long as no keyframe lies in between
+        if not self.position <= frame_number or keyframe > self.position:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            self.position = keyframe
+        while self.position < frame_number and self.capture.grab():
+            self.position += 1
+
+    def read(self, frame_number: int) -> Any:
+        """Returns the decoded frame, which must not be modified, or None past the end."""
+        frame = self.frames.get(frame_number)
+        if frame is not None:
+            return frame
+        with self.lock:
+            if self.position != frame_number:
+                self.seek(frame_number)
+            has_frame, frame = self.capture.read()
+            if not has_frame:
+                return None
+            self.position = frame_number + 1
+        self.frames.put(frame_number, frame)
+        return frame
 
-    if has_frame and modules.globals.color_correction:
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    def release(self) -> None:
+        with self.lock:
+            self.capture.release()
 
-    capture.release()
-    return frame if has_frame else None
+
+READER: VideoReader = None
+READER_LOCK = threading.Lock()
+
+
+def get_video_reader(video_path: str) -> VideoReader:
+    """Returns the reader of the video, reopening it only when another video is requested."""
+    global READER
+
+    with READER_LOCK:
+        if READER is None or READER.video_path != video_path:
+            if READER is not None:
+                READER.release()
+            READER = VideoReader(video_path)
+        return READER
+
+
+def release_video_reader() -> None:
+    """Drops the decoded frames of the reader, the video stays open."""
+    if READER is not None:
+        READER.frames.clear()
+
+
+register_release(release_video_reader)
+
+
+def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
+    frame = get_video_reader(video_path).read(int(frame_number))
+    if frame is None:
+        return None
+
+    # the reader keeps decoded frames cached, so callers get their own pooled copy
+    if modules.globals.color_correction:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=BUFFER_POOL.like(frame))
+    temp_frame = BUFFER_POOL.like(frame)
+    np.copyto(temp_frame, frame)
+    return temp_frame
 
 
 def get_video_frame_total(video_path: str) -> int:
-    with cv2.VideoCapture(video_path) as capture:
-        return int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    try:
+        return probe(video_path).frame_total
+    except Exception:
+        capture = cv2.VideoCapture(video_path)
+        frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        return frame_total
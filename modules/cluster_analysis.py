@@ -20,6 +20,10 @@ def find_cluster_centroids(embeddings, max_k=10) -> Any:
 
     return optimal_centroids
 
+def assign_centroids(centroids: Any, normed_face_embeddings: Any) -> Any:
+    """Returns the index of the closest centroid for every embedding, all with one matrix product."""
+    return np.argmax(np.asarray(normed_face_embeddings) @ np.asarray(centroids).T, axis=1)
+
 def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
     try:
         centroids = np.array(centroids)
@@ -1,7 +1,17 @@
-import os, sys, warnings, platform, signal, shutil, argparse, torch, onnxruntime, tensorflow, modules.globals, modules.metadata, modules.ui as ui
+import os, sys, warnings, signal, shutil, argparse, torch, onnxruntime, tensorflow, modules.globals, modules.metadata, modules.ui as ui
 from typing import List
-from modules.processors.frame.core import get_frame_processors_modules
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from modules.processors.frame.core import clear_frame_processors_modules, get_frame_processors_modules, process_video_fused
+from modules.capturer import get_video_frame_total
+from modules.frame_store import TEMP_FRAME_FORMATS, get_temp_frame_format
+from modules.frame_filter import count, filter_faceless_frame_paths, find_duplicate_frame_paths, reuse_duplicate_frames, reset_stats, get_summary
+from modules.frame_ring import process_video_stream
+from modules.batch import process_image_directory
+from modules.events import EVENTS, open_event_stream
+from modules.orchestrator import process_video_orchestrated
+from modules.predicter import NsfwScreen
+from modules.segmenter import can_copy_segments, process_video_segments, process_video_smart
+from modules.shards import create_job, load_job, run_worker, wait_for_shards, assemble_job
+from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, get_temp_output_path, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path, is_image_directory, has_audio
 
 if any(arg.startswith('--execution-provider') for arg in sys.argv):
     os.environ['OMP_NUM_THREADS'] = '1'
@@ -17,22 +27,46 @@ def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser()
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
-    program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
+    program.add_argument('-t', '--target', help='select an target image, video or directory of images', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
     program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
+    program.add_argument('--skip-faceless', help='pass frames without faces to the encoder untouched', dest='skip_faceless', action='store_true', default=False)
+    program.add_argument('--duplicate-threshold', help='reuse the previous output for frames whose mean difference to it is at most this threshold (0 reuses exact duplicates only)', dest='duplicate_threshold', type=float)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
+    program.add_argument('--nsfw-interval', help='check every n-th frame of a video for NSFW content', dest='nsfw_interval', type=int, default=100)
     program.add_argument('--map-faces', help='map source target faces', dest='map_faces', action='store_true', default=False)
+    program.add_argument('--smart-render', help='stream-copy GOPs without faces from the target and only re-encode the others', dest='smart_render', action='store_true', default=False)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
+    program.add_argument('--temp-frame-format', help='intermediate frame format', dest='temp_frame_format', default='png', choices=TEMP_FRAME_FORMATS)
+    program.add_argument('--temp-frame-compression', help='png compression level of intermediate frames', dest='temp_frame_compression', type=int, default=1, choices=range(10), metavar='[0-9]')
+    program.add_argument('--frame-ring-size', help='number of shared memory frame slots between decoder, processors and encoder (0 uses temp frames)', dest='frame_ring_size', type=int, default=0)
+    program.add_argument('--frame-ring-workers', help='run frame ring processors in threads or processes', dest='frame_ring_workers', default='thread', choices=['thread', 'process'])
+    program.add_argument('--segment-jobs', help='number of keyframe aligned segments processed and encoded in parallel', dest='segment_jobs', type=int, default=1)
+    program.add_argument('--segment-retries', help='number of retries for a failed segment', dest='segment_retries', type=int, default=1)
+    program.add_argument('--shard-dir', help='shared work directory for sharded rendering across processes or machines', dest='shard_dir')
+    program.add_argument('--shard-role', help='create and assemble the sharded job, only render shards, or only assemble them', dest='shard_role', default='worker', choices=['coordinator', 'worker', 'assemble'])
+    program.add_argument('--shard-count', help='number of frame-range shards the coordinator splits the job into', dest='shard_count', type=int, default=8)
     program.add_argument('--live-mirror', help='The live camera display as you see it in the front-facing camera frame', dest='live_mirror', action='store_true', default=False)
     program.add_argument('--live-resizable', help='The live camera frame is resizable', dest='live_resizable', action='store_true', default=False)
-    program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
+    program.add_argument('--live-sink', help='extra outputs of the live camera, shm:NAME shares the latest frame in shared memory, ffmpeg:PATH_OR_URL records or streams it', dest='live_sinks', default=[], nargs='+')
+    program.add_argument('--live-recheck-interval', help='frames after which a tracked live face is recognized again in map faces mode (0 recognizes every frame)', dest='live_recheck_interval', type=int, default=30)
+    program.add_argument('--event-stream', help='write JSON lines progress events to a file, fd:N, tcp://host:port or unix:///path', dest='event_stream')
+    program.add_argument('--max-memory', help='memory budget in GB, frames in flight are throttled and caches dropped to stay inside it, unlimited when not given', dest='max_memory', type=int)
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--model-mirror', help='directory to take models from instead of downloading them', dest='model_mirror')
+    program.add_argument('--session-optimization', help='graph optimization level of the model sessions', dest='session_optimization', default='all', choices=['disable', 'basic', 'extended', 'all'])
+    program.add_argument('--session-execution-mode', help='run the operators of a model session sequentially or in parallel', dest='session_execution_mode', default='sequential', choices=['sequential', 'parallel'])
+    program.add_argument('--session-threads', help='number of intra-op threads per model session (0 lets the runtime decide)', dest='session_threads', type=int, default=0)
+    program.add_argument('--session-thread-affinity', help='intra-op thread affinities of the model sessions, e.g. "1,2;3,4"', dest='session_thread_affinity')
+    program.add_argument('--no-memory-arena', help='disable the CPU memory arena of the model sessions', dest='session_memory_arena', action='store_false', default=True)
+    program.add_argument('--no-optimized-cache', help='do not cache the optimized models between launches', dest='optimized_cache', action='store_false', default=True)
+    program.add_argument('--quantized-models', help='use the INT8 models created with python -m modules.quantize where available', dest='quantized_models', action='store_true', default=False)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -47,20 +81,47 @@ def parse_args() -> None:
     modules.globals.target_path = args.target_path
     modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
-    modules.globals.headless = args.source_path or args.target_path or args.output_path
+    modules.globals.headless = args.source_path or args.target_path or args.output_path or args.shard_dir
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
     modules.globals.many_faces = args.many_faces
     modules.globals.nsfw_filter = args.nsfw_filter
+    modules.globals.nsfw_interval = max(1, args.nsfw_interval)
+    modules.globals.skip_faceless = args.skip_faceless
+    modules.globals.duplicate_threshold = args.duplicate_threshold
     modules.globals.map_faces = args.map_faces
+    modules.globals.smart_render = args.smart_render
     modules.globals.video_encoder = args.video_encoder
     modules.globals.video_quality = args.video_quality
+    modules.globals.temp_frame_format = args.temp_frame_format
+    modules.globals.temp_frame_compression = args.temp_frame_compression
+    modules.globals.frame_ring_size = args.frame_ring_size
+    modules.globals.frame_ring_workers = args.frame_ring_workers
+    modules.globals.segment_jobs = args.segment_jobs
+    modules.globals.segment_retries = args.segment_retries
+    modules.globals.shard_dir = args.shard_dir
+    modules.globals.shard_role = args.shard_role
+    modules.globals.shard_count = args.shard_count
     modules.globals.live_mirror = args.live_mirror
     modules.globals.live_resizable = args.live_resizable
+    modules.globals.live_sinks = args.live_sinks
+    for sink in args.live_sinks:
+        if not sink.startswith(('shm:', 'ffmpeg:')):
+            program.error(f'argument --live-sink: {sink} is neither shm:NAME nor ffmpeg:PATH_OR_URL')
+    modules.globals.live_recheck_interval = max(0, args.live_recheck_interval)
+    modules.globals.event_stream = args.event_stream
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
     modules.globals.execution_threads = args.execution_threads
+    modules.globals.model_mirror = args.model_mirror
+    modules.globals.session_optimization = args.session_optimization
+    modules.globals.session_execution_mode = args.session_execution_mode
+    modules.globals.session_threads = args.session_threads
+    modules.globals.session_thread_affinity = args.session_thread_affinity
+    modules.globals.session_memory_arena = args.session_memory_arena
+    modules.globals.optimized_cache = args.optimized_cache
+    modules.globals.quantized_models = args.quantized_models
 
     #for ENHANCER tumbler:
     if 'face_enhancer' in args.frame_processor:
@@ -96,11 +157,6 @@ def decode_execution_providers(execution_providers: List[str]) -> List[str]:
     return [provider for provider, encoded_execution_provider in zip(onnxruntime.get_available_providers(), encode_execution_providers(onnxruntime.get_available_providers()))
             if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
 
-def suggest_max_memory() -> int:
-    if platform.system().lower() == 'darwin':
-        return 4
-    return 16
-
 def suggest_execution_providers() -> List[str]:
     return encode_execution_providers(onnxruntime.get_available_providers())
 
@@ -116,18 +172,7 @@ def limit_resources() -> None:
     gpus = tensorflow.config.experimental.list_physical_devices('GPU')
     for gpu in gpus:
         tensorflow.config.experimental.set_memory_growth(gpu, True)
-    # limit memory usage
-    if modules.globals.max_memory:
-        memory = modules.globals.max_memory * 1024 ** 3
-        if platform.system().lower() == 'darwin':
-            memory = modules.globals.max_memory * 1024 ** 6
-        if platform.system().lower() == 'windows':
-            import ctypes
-            kernel32 = ctypes.windll.kernel32
-            kernel32.SetProcessWorkingSetSize(-1, ctypes.c_size_t(memory), ctypes.c_size_t(memory))
-        else:
-            import resource
-            resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+    # memory usage is kept inside --max-memory by the memory governor of modules.memory
 
 def release_resources() -> None:
     if 'CUDAExecutionProvider' in modules.globals.execution_providers:
@@ -144,6 +189,7 @@ def pre_check() -> bool:
 
 def update_status(message: str, scope: str = 'DLC.CORE') -> None:
     print(f'[{scope}] {message}')
+    EVENTS.set_stage(message, scope)
     if not modules.globals.headless:
         ui.update_status(message)
 
@@ -152,6 +198,16 @@ def start() -> None:
         if not frame_processor.pre_start():
             return
     update_status('Processing...')
+    reset_stats()
+    # process image directory to directory
+    if is_image_directory(modules.globals.target_path):
+        if modules.globals.map_faces:
+            update_status('Mapping faces is not supported for directories of images!')
+            return
+        processed, total = process_image_directory(modules.globals.source_path, modules.globals.target_path, modules.globals.output_path)
+        release_resources()
+        update_status(f'Processed {processed} of {total} images!')
+        return
     # process image to image
     if has_image_extension(modules.globals.target_path):
         if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
@@ -169,32 +225,104 @@ def start() -> None:
         else:
             update_status('Processing to image failed!')
         return
-    # process image to videos
-    if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
-        return
+    # process image to videos, screened on the frames the pipeline decodes anyway
+    screen = NsfwScreen(modules.globals.target_path) if modules.globals.nsfw_filter else None
+    if screen is not None and screen.verdict:
+        return ignore_nsfw()
 
-    if not modules.globals.map_faces:
+    audio_muxed = False
+    smart_render = modules.globals.smart_render and not modules.globals.map_faces
+    if smart_render and not (modules.globals.keep_fps and can_copy_segments(modules.globals.target_path, detect_fps(modules.globals.target_path))):
+        update_status('Smart rendering needs --keep-fps and a yuv420p target in the codec of the video encoder, rendering every frame...')
+        smart_render = False
+
+    if smart_render:
         update_status('Creating temp resources...')
         create_temp(modules.globals.target_path)
-        update_status('Extracting frames...')
-        extract_frames(modules.globals.target_path)
-
-    temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
-        release_resources()
-    # handles fps
-    if modules.globals.keep_fps:
-        update_status('Detecting fps...')
         fps = detect_fps(modules.globals.target_path)
-        update_status(f'Creating video with {fps} fps...')
-        create_video(modules.globals.target_path, fps)
+        update_status(f'Processing GOPs with faces and copying the others with {fps} fps...')
+        result = process_video_smart(modules.globals.source_path, modules.globals.target_path, get_temp_output_path(modules.globals.target_path), fps, screen)
+        release_resources()
+        if screen is not None and screen.finish():
+            return ignore_nsfw()
+        if not result:
+            update_status('Smart rendering failed!')
+    elif modules.globals.segment_jobs > 1 and not modules.globals.map_faces:
+        update_status('Creating temp resources...')
+        create_temp(modules.globals.target_path)
+        source_fps = detect_fps(modules.globals.target_path)
+        fps = source_fps if modules.globals.keep_fps else 30.0
+        update_status(f'Processing {modules.globals.segment_jobs} segments in parallel with {fps} fps...')
+        result = process_video_segments(modules.globals.source_path, modules.globals.target_path, get_temp_output_path(modules.globals.target_path), fps, source_fps, screen)
+        release_resources()
+        if screen is not None and screen.finish():
+            return ignore_nsfw()
+        if not result:
+            update_status('Processing segments failed!')
+    elif modules.globals.frame_ring_size and not modules.globals.map_faces:
+        update_status('Creating temp resources...')
+        create_temp(modules.globals.target_path)
+        fps = detect_fps(modules.globals.target_path) if modules.globals.keep_fps else 30.0
+        update_status(f'Processing frames through the frame ring with {fps} fps...')
+        process_video_stream(modules.globals.source_path, modules.globals.target_path, get_temp_output_path(modules.globals.target_path), fps, screen=screen)
+        release_resources()
+        if screen is not None and screen.finish():
+            return ignore_nsfw()
+    elif not modules.globals.map_faces and modules.globals.duplicate_threshold is None and get_temp_frame_format() != 'npy' and not modules.globals.keep_frames:
+        update_status('Creating temp resources...')
+        create_temp(modules.globals.target_path)
+        fps = detect_fps(modules.globals.target_path) if modules.globals.keep_fps else 30.0
+        audio_muxed = modules.globals.keep_audio and has_audio(modules.globals.target_path)
+        update_status(f'Extracting, processing and creating video with {fps} fps at once...')
+        result = process_video_orchestrated(modules.globals.source_path, modules.globals.target_path, get_temp_output_path(modules.globals.target_path), fps, get_video_frame_total(modules.globals.target_path), screen, audio_muxed)
+        release_resources()
+        if screen is not None and screen.finish():
+            return ignore_nsfw()
+        if not result:
+            update_status('Processing failed!')
+            audio_muxed = False
     else:
-        update_status('Creating video with 30.0 fps...')
-        create_video(modules.globals.target_path)
-    # handle audio
-    if modules.globals.keep_audio:
+        if not modules.globals.map_faces:
+            update_status('Creating temp resources...')
+            create_temp(modules.globals.target_path)
+            update_status('Extracting frames...')
+            extract_frames(modules.globals.target_path)
+
+        temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        if screen is not None:
+            update_status('Screening frames...')
+            if screen.feed_frame_paths(temp_frame_paths):
+                return ignore_nsfw()
+        count('frames', len(temp_frame_paths))
+        duplicates = {}
+        if modules.globals.duplicate_threshold is not None:
+            update_status('Finding duplicate frames...')
+            temp_frame_paths, duplicates = find_duplicate_frame_paths(temp_frame_paths)
+        if modules.globals.skip_faceless and not modules.globals.map_faces:
+            update_status('Detecting frames with faces...')
+            temp_frame_paths = filter_faceless_frame_paths(temp_frame_paths)
+        if modules.globals.map_faces:
+            for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+                update_status('Progressing...', frame_processor.NAME)
+                frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+                release_resources()
+        else:
+            # all processors in one pass, so every frame is read and written once
+            update_status('Progressing...', ', '.join(frame_processor.NAME for frame_processor in get_frame_processors_modules(modules.globals.frame_processors)))
+            process_video_fused(modules.globals.source_path, temp_frame_paths, get_frame_processors_modules(modules.globals.frame_processors))
+            release_resources()
+        reuse_duplicate_frames(duplicates)
+        # handles fps
+        if modules.globals.keep_fps:
+            update_status('Detecting fps...')
+            fps = detect_fps(modules.globals.target_path)
+            update_status(f'Creating video with {fps} fps...')
+            create_video(modules.globals.target_path, fps)
+        else:
+            update_status('Creating video with 30.0 fps...')
+            create_video(modules.globals.target_path)
+    # handle audio, unless it was muxed while encoding
+    if modules.globals.keep_audio and not audio_muxed:
         if modules.globals.keep_fps:
             update_status('Restoring audio...')
         else:
@@ -202,6 +330,9 @@ def start() -> None:
         restore_audio(modules.globals.target_path, modules.globals.output_path)
     else:
         move_temp(modules.globals.target_path, modules.globals.output_path)
+    summary = get_summary()
+    if summary:
+        update_status(summary)
     # clean and validate
     clean_temp(modules.globals.target_path)
     if is_video(modules.globals.target_path):
@@ -209,6 +340,42 @@ def start() -> None:
     else:
         update_status('Processing to video failed!')
 
+def ignore_nsfw() -> None:
+    destroy(to_quit=False)
+    update_status('Processing ignored!')
+
+def start_shards() -> None:
+    shard_dir = modules.globals.shard_dir
+    if modules.globals.shard_role == 'coordinator':
+        update_status('Creating shards...')
+        create_job(shard_dir, modules.globals.source_path, modules.globals.target_path, modules.globals.output_path, modules.globals.shard_count)
+    update_status('Loading job...')
+    job = load_job(shard_dir)
+    if modules.globals.shard_role != 'assemble':
+        # the job may name other frame processors than this worker was started with
+        clear_frame_processors_modules()
+        for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+            if not frame_processor.pre_check() or not frame_processor.pre_start():
+                return
+        update_status('Processing shards...')
+        reset_stats()
+        update_status(f'Rendered {run_worker(shard_dir, job)} shards.')
+        summary = get_summary()
+        if summary:
+            update_status(summary)
+        release_resources()
+    if modules.globals.shard_role == 'coordinator':
+        update_status('Waiting for shards...')
+        if not wait_for_shards(shard_dir, job):
+            update_status('Processing to video failed, a shard failed too often!')
+            return
+    if modules.globals.shard_role != 'worker':
+        update_status('Assembling shards...')
+        if assemble_job(shard_dir, job):
+            update_status('Processing to video succeed!')
+        else:
+            update_status('Processing to video failed!')
+
 def destroy(to_quit=True) -> None:
     if modules.globals.target_path:
         clean_temp(modules.globals.target_path)
@@ -216,13 +383,16 @@ def destroy(to_quit=True) -> None:
 
 def run() -> None:
     parse_args()
+    open_event_stream()
     if not pre_check():
         return
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_check():
             return
     limit_resources()
-    if modules.globals.headless:
+    if modules.globals.shard_dir:
+        start_shards()
+    elif modules.globals.headless:
         start()
     else:
         window = ui.init(start, destroy)
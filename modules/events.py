@@ -0,0 +1,136 @@
+import atexit, json, os, queue, socket, threading, time, modules.globals
+from typing import Any, List, TextIO
+from modules.memory import GOVERNOR, get_usage
+
+NAME = 'DLC.EVENTS'
+# Seconds between progress events, the frame loops never wait on the stream
+EVENT_INTERVAL = 1.0
+# Weight of the latest sample in the smoothed fps
+FPS_SMOOTHING = 0.2
+# Events waiting for the sampler thread to write them, further ones are dropped rather than blocking the frame loops
+EVENT_QUEUE_SIZE = 1024
+
+
+def open_stream(target: str) -> TextIO:
+    """Opens the event stream target, a file path, fd:N, tcp://host:port or unix:///path."""
+    if target.startswith('fd:'):
+        return os.fdopen(int(target[3:]), 'w', buffering=1)
+    if target.startswith('tcp://'):
+        host, _, port = target[6:].rpartition(':')
+        return socket.create_connection((host, int(port))).makefile('w', buffering=1)
+    if target.startswith('unix://'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(target[7:])
+        return connection.makefile('w', buffering=1)
+    return open(target, 'a', buffering=1)
+
+
+class EventStream:
+    """Writes JSON lines events from a background thread, progress is sampled by it at a bounded rate."""
+
+    def __init__(self) -> None:
+        self.stream: TextIO = None
+        self.progresses: List[Any] = []
+        self.stage = None
+        self.lock = threading.Lock()
+        self.events: queue.Queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped = 0
+        self.sampler: threading.Thread = None
+
+    def open(self, target: str) -> None:
+        self.stream = open_stream(target)
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """Lets the sampler thread write the queued events before the process exits."""
+        if self.sampler is None or not self.sampler.is_alive():
+            return
+        try:
+            self.events.put(None, timeout=EVENT_INTERVAL)
+        except queue.Full:
+            return
+        self.sampler.join(EVENT_INTERVAL)
+
+    def emit(self, event: str, **fields: Any) -> None:
+        if self.stream is None:
+            return
+        line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, default=str)
+        try:
+            self.events.put_nowait(line)
+        except queue.Full:
+            # a slow reader must not stall processing, the progress events report how many were lost
+            self.dropped += 1
+
+    def write(self, line: str) -> None:
+        try:
+            self.stream.write(line + '\n')
+        except (OSError, ValueError) as exception:
+            # a reader going away must not take the job down
+            print(f'[{NAME}] Event stream closed: {exception}')
+            self.stream = None
+
+    def set_stage(self, message: str, scope: str) -> None:
+        self.stage = message
+        self.emit('stage', scope=scope, message=message)
+
+    def watch(self, progress: Any) -> Any:
+        """Reports the progress bar in the progress events until it is closed."""
+        if self.stream is not None:
+            with self.lock:
+                self.progresses.append(progress)
+        return progress
+
+    def sample(self) -> None:
+        """Writes the queued events as they come and a progress event every interval."""
+        last_frames, last_time, smoothed_fps = None, time.monotonic(), None
+        sample_time = last_time + EVENT_INTERVAL
+        while self.stream is not None:
+            try:
+                line = self.events.get(timeout=max(0.0, sample_time - time.monotonic()))
+            except queue.Empty:
+                line = ''
+            if line is None:
+                return
+            if line:
+                self.write(line)
+            if time.monotonic() < sample_time:
+                continue
+            sample_time = time.monotonic() + EVENT_INTERVAL
+            with self.lock:
+                progresses = list(self.progresses)
+                # tqdm disables a bar when it is closed
+                self.progresses = [progress for progress in progresses if not progress.disable]
+            if not progresses:
+                last_frames, smoothed_fps = None, None
+                continue
+            now = time.monotonic()
+            frames = sum(progress.n for progress in progresses)
+            totals = [progress.total for progress in progresses]
+            total = sum(totals) if all(totals) else None
+            fps = (frames - last_frames) / (now - last_time) if last_frames is not None and frames >= last_frames else None
+            if fps is not None:
+                smoothed_fps = fps if smoothed_fps is None else FPS_SMOOTHING * fps + (1 - FPS_SMOOTHING) * smoothed_fps
+            last_frames, last_time = frames, now
+            self.write(json.dumps({'event': 'progress', 'time': round(time.time(), 3), 'stage': self.stage, 'task': progresses[0].desc, 'frames': frames, 'total': total,
+                                   'fps': round(fps, 2) if fps is not None else None,
+                                   'smoothed_fps': round(smoothed_fps, 2) if smoothed_fps is not None else None,
+                                   'eta': round((total - frames) / smoothed_fps, 1) if total and smoothed_fps else None,
+                                   'in_flight': GOVERNOR.in_flight, 'window': GOVERNOR.window, 'memory': get_usage(), 'dropped': self.dropped}, default=str))
+
+
+EVENTS = EventStream()
+
+
+def open_event_stream() -> None:
+    if modules.globals.event_stream:
+        EVENTS.open(modules.globals.event_stream)
+
+
+def emit(event: str, **fields: Any) -> None:
+    EVENTS.emit(event, **fields)
+
+
+def watch_progress(progress: Any) -> Any:
+    return EVENTS.watch(progress)
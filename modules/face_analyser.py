@@ -1,9 +1,11 @@
-import shutil, cv2, numpy as np, insightface, modules.globals
+import shutil, threading, cv2, numpy as np, modules.globals
 from tqdm import tqdm
 from typing import Any, List, Dict
 from pathlib import Path
 from modules.typing import Frame
-from modules.cluster_analysis import find_cluster_centroids, find_closest_centroid
+from modules.frame_store import read_frame
+from modules.cluster_analysis import find_cluster_centroids, assign_centroids
+from modules.sessions import create_face_analyser
 from modules.utilities import (
     get_temp_directory_path, create_temp, extract_frames,
     clean_temp, get_temp_frame_paths
@@ -11,21 +13,49 @@ from modules.utilities import (
 
 # Global face analysis object
 FACE_ANALYSER = None
+FACE_DETECTOR = None
+FACE_DETECTOR_SIZE = (320, 320)
+THREAD_LOCK = threading.Lock()
 
 def get_face_analyser() -> Any:
     """Initializes and returns the face analyzer."""
     global FACE_ANALYSER
 
     if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
+        FACE_ANALYSER = create_face_analyser('buffalo_l')
         FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
     return FACE_ANALYSER
 
 
+def get_face_detector() -> Any:
+    """Initializes and returns a detection-only analyser at reduced input size."""
+    global FACE_DETECTOR
+
+    with THREAD_LOCK:
+        if FACE_DETECTOR is None:
+            FACE_DETECTOR = create_face_analyser('buffalo_l', allowed_modules=['detection'])
+            FACE_DETECTOR.prepare(ctx_id=0, det_size=FACE_DETECTOR_SIZE)
+    return FACE_DETECTOR
+
+
+def has_face(frame: Frame) -> bool:
+    """Checks cheaply whether the frame contains any face."""
+    return frame is not None and len(get_face_detector().get(frame, max_num=1)) > 0
+
+
+def has_any_face(frame: Frame) -> bool:
+    """Checks whether the frame contains any face with the full-size detector of the analyser."""
+    return frame is not None and len(get_face_analyser().det_model.detect(frame, max_num=1, metric='default')[0]) > 0
+
+
+def get_first_face(faces: List[Any]) -> Any:
+    """Gets the leftmost of the faces."""
+    return min(faces, key=lambda x: x.bbox[0]) if faces else None
+
+
 def get_one_face(frame: Frame) -> Any:
     """Gets a single face from the given frame."""
-    faces = get_face_analyser().get(frame)
-    return min(faces, key=lambda x: x.bbox[0]) if faces else None
+    return get_first_face(get_face_analyser().get(frame))
 
 
 def get_many_faces(frame: Frame) -> List[Any]:
@@ -55,7 +85,8 @@ def simplify_maps() -> None:
             centroids.append(map['target']['face'].normed_embedding)
             faces.append(map['source']['face'])
     
-    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': centroids}
+    # stacked once, so live lookups are a single matrix product per frame
+    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': np.array(centroids)}
 
 
 def add_blank_map() -> None:
@@ -95,28 +126,28 @@ def get_unique_faces_from_target_video() -> None:
         temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
 
         for i, temp_frame_path in enumerate(tqdm(temp_frame_paths, desc="Extracting face embeddings")):
-            temp_frame = cv2.imread(temp_frame_path)
+            temp_frame = read_frame(temp_frame_path)
             faces = get_many_faces(temp_frame)
             
             face_embeddings.extend([face.normed_embedding for face in faces])
             frame_face_embeddings.append({'frame': i, 'faces': faces, 'location': temp_frame_path})
 
         centroids = find_cluster_centroids(face_embeddings)
+        faces = [face for frame in frame_face_embeddings for face in frame['faces']]
 
-        for frame in frame_face_embeddings:
-            for face in frame['faces']:
-                closest_centroid_index, _ = find_closest_centroid(centroids, face.normed_embedding)
-                face['target_centroid'] = closest_centroid_index
+        for face, closest_centroid_index in zip(faces, assign_centroids(centroids, np.stack(face_embeddings))):
+            face['target_centroid'] = int(closest_centroid_index)
 
-        for i, _ in enumerate(centroids):
-            modules.globals.souce_target_map.append({'id': i, 'target_faces_in_frame': []})
+        modules.globals.souce_target_map = [{'id': i, 'target_faces_in_frame': []} for i in range(len(centroids))]
 
-            for frame in tqdm(frame_face_embeddings, desc=f"Mapping frame embeddings to centroid-{i}"):
-                mapped_faces = [face for face in frame['faces'] if face['target_centroid'] == i]
-                if mapped_faces:
-                    modules.globals.souce_target_map[i]['target_faces_in_frame'].append(
-                        {'frame': frame['frame'], 'faces': mapped_faces, 'location': frame['location']}
-                    )
+        for frame in frame_face_embeddings:
+            mapped_faces: Dict[int, List[Any]] = {}
+            for face in frame['faces']:
+                mapped_faces.setdefault(face['target_centroid'], []).append(face)
+            for i, faces in mapped_faces.items():
+                modules.globals.souce_target_map[i]['target_faces_in_frame'].append(
+                    {'frame': frame['frame'], 'faces': faces, 'location': frame['location']}
+                )
 
         default_target_face()
     except Exception:
@@ -141,7 +172,7 @@ def default_target_face() -> None:
 
         if best_face:
             x_min, y_min, x_max, y_max = best_face['bbox']
-            target_frame = cv2.imread(best_frame['location'])
+            target_frame = read_frame(best_frame['location'])
             map['target'] = {
                 'cv2': target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
                 'face': best_face
@@ -159,7 +190,7 @@ def dump_faces(centroids: Any, frame_face_embeddings: List[Dict]) -> None:
         cluster_dir.mkdir(parents=True, exist_ok=True)
 
         for frame in tqdm(frame_face_embeddings, desc=f"Copying faces to temp/{i}"):
-            temp_frame = cv2.imread(frame['location'])
+            temp_frame = read_frame(frame['location'])
 
             for j, face in enumerate(frame['faces']):
                 if face['target_centroid'] == i:
@@ -0,0 +1,114 @@
+import threading, numpy as np, modules.globals
+from insightface.app.common import Face
+from typing import Any, Dict, List, Tuple
+from modules.cluster_analysis import assign_centroids
+from modules.face_analyser import get_face_analyser
+from modules.typing import Frame
+
+# Minimum box overlap for a detection to continue a track
+TRACK_IOU_THRESHOLD = 0.3
+# Below this overlap the face moved too far between frames to trust its identity without a re-check
+TRACK_STABLE_IOU = 0.6
+# Detection score below which the identity of a track is checked again
+TRACK_MIN_SCORE = 0.6
+# Frames a track survives without a matching detection, so a single missed detection keeps the identity
+TRACK_MAX_MISSES = 3
+
+
+def get_iou(boxes: Any, other_boxes: Any) -> Any:
+    """Returns the intersection over union of every box in the first array with every box in the second."""
+    boxes, other_boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4), np.asarray(other_boxes, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(boxes[:, None, :2], other_boxes[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], other_boxes[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    other_areas = np.prod(other_boxes[:, 2:] - other_boxes[:, :2], axis=1)
+    return intersection / np.maximum(areas[:, None] + other_areas[None, :] - intersection, 1e-6)
+
+
+class Track:
+    """A face followed across frames together with the map entry it was recognized as."""
+
+    def __init__(self, face: Face) -> None:
+        self.face = face
+        self.identity: int = None
+        self.age = 0
+        self.misses = 0
+
+
+class FaceTracker:
+    """Follows live faces by box overlap, so the recognition model only runs for new, uncertain or due tracks."""
+
+    def __init__(self) -> None:
+        self.tracks: List[Track] = []
+        self.simple_map: Dict[str, Any] = None
+        self.lock = threading.Lock()
+
+    def detect(self, frame: Frame) -> List[Face]:
+        bboxes, kpss = get_face_analyser().det_model.detect(frame, max_num=0, metric='default')
+        if kpss is None:
+            return []
+        return [Face(bbox=bbox[:4], kps=kps, det_score=bbox[4]) for bbox, kps in zip(bboxes, kpss)]
+
+    def match(self, faces: List[Face]) -> Dict[int, Tuple[Track, float]]:
+        """Pairs detections with tracks greedily, best overlap first."""
+        matches: Dict[int, Tuple[Track, float]] = {}
+        if not faces or not self.tracks:
+            return matches
+        ious = get_iou([face.bbox for face in faces], [track.face.bbox for track in self.tracks])
+        while True:
+            face_index, track_index = np.unravel_index(np.argmax(ious), ious.shape)
+            iou = float(ious[face_index, track_index])
+            if iou < TRACK_IOU_THRESHOLD:
+                return matches
+            matches[int(face_index)] = (self.tracks[track_index], iou)
+            ious[face_index, :] = -1
+            ious[:, track_index] = -1
+
+    def recognize(self, frame: Frame, tracks: List[Track]) -> None:
+        if not tracks:
+            return
+        recognition = get_face_analyser().models['recognition']
+        for track in tracks:
+            recognition.get(frame, track.face)
+            track.age = 0
+        identities = assign_centroids(self.simple_map['target_embeddings'], np.stack([track.face.normed_embedding for track in tracks]))
+        for track, identity in zip(tracks, identities):
+            track.identity = int(identity)
+
+    def update(self, frame: Frame) -> List[Tuple[Face, int]]:
+        """Returns the faces of the frame with the index of their source in the simple map."""
+        with self.lock:
+            if modules.globals.simple_map is not self.simple_map:
+                self.tracks = []
+                self.simple_map = modules.globals.simple_map
+            if not self.simple_map or not len(self.simple_map['target_embeddings']):
+                return []
+            faces = self.detect(frame)
+            matches = self.match(faces)
+            interval = modules.globals.live_recheck_interval
+            tracks, pending = [], []
+            for face_index, face in enumerate(faces):
+                track, iou = matches.get(face_index, (None, 0.0))
+                if track is None:
+                    track = Track(face)
+                else:
+                    track.face = face
+                    track.age += 1
+                    track.misses = 0
+                if track.identity is None or iou < TRACK_STABLE_IOU or face.det_score < TRACK_MIN_SCORE or not interval or track.age >= interval:
+                    pending.append(track)
+                tracks.append(track)
+            self.recognize(frame, pending)
+            for track in self.tracks:
+                if track not in tracks:
+                    track.misses += 1
+            self.tracks = tracks + [track for track in self.tracks if track not in tracks and track.misses <= TRACK_MAX_MISSES]
+            return [(track.face, track.identity) for track in tracks]
+
+
+FACE_TRACKER = FaceTracker()
+
+
+def get_tracked_faces(frame: Frame) -> List[Tuple[Face, int]]:
+    return FACE_TRACKER.update(frame)
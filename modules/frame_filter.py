@@ -0,0 +1,106 @@
+import hashlib, shutil, threading, cv2, numpy as np, modules.globals
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+from tqdm import tqdm
+from modules.events import watch_progress
+from modules.face_analyser import has_face
+from modules.frame_store import get_frame_number, read_frame
+from modules.typing import Frame
+
+# Counters of frames that were passed through without running the frame processors
+STATS: Dict[str, int] = {'frames': 0, 'faceless': 0, 'duplicate': 0}
+STATS_LOCK = threading.Lock()
+
+# Size of the grayscale thumbnail near duplicates are compared on
+SIGNATURE_SIZE = (64, 36)
+
+
+def reset_stats() -> None:
+    with STATS_LOCK:
+        for name in STATS:
+            STATS[name] = 0
+
+
+def count(name: str, amount: int = 1) -> None:
+    with STATS_LOCK:
+        STATS[name] += amount
+
+
+def is_faceless(frame: Frame) -> bool:
+    """Checks whether the frame can skip the frame processors because it has no face."""
+    if has_face(frame):
+        return False
+    count('faceless')
+    return True
+
+
+def filter_faceless_frame_paths(temp_frame_paths: List[str]) -> List[str]:
+    """Returns the frames that contain a face, the others stay untouched for the encoder."""
+    with tqdm(total=len(temp_frame_paths), desc='Detecting faces', unit='frame', dynamic_ncols=True) as progress:
+        watch_progress(progress)
+
+        def check(temp_frame_path: str) -> bool:
+            result = not is_faceless(read_frame(temp_frame_path))
+            progress.update(1)
+            return result
+
+        with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
+            results = list(executor.map(check, temp_frame_paths))
+    return [temp_frame_path for temp_frame_path, result in zip(temp_frame_paths, results) if result]
+
+
+def get_signature(frame: Frame) -> Any:
+    """Returns what duplicates are compared on: a content hash or a small grayscale thumbnail."""
+    if not modules.globals.duplicate_threshold:
+        return hashlib.blake2b(np.ascontiguousarray(frame).data, digest_size=16).digest()
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def is_duplicate(reference_signature: Any, signature: Any) -> bool:
+    """Checks whether the frame is an exact or, above a zero threshold, a near duplicate of the reference."""
+    if reference_signature is None:
+        return False
+    if not modules.globals.duplicate_threshold:
+        return reference_signature == signature
+    return cv2.norm(reference_signature, signature, cv2.NORM_L1) / reference_signature.size <= modules.globals.duplicate_threshold
+
+
+def find_duplicate_frame_paths(temp_frame_paths: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    """Splits the frames into the ones to process and the duplicates mapped to the frame they reuse."""
+    # runs of duplicates only make sense between neighbouring frames
+    temp_frame_paths = sorted(temp_frame_paths, key=get_frame_number)
+    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
+        signatures = list(tqdm(executor.map(lambda temp_frame_path: get_signature(read_frame(temp_frame_path)), temp_frame_paths), total=len(temp_frame_paths), desc='Finding duplicates', unit='frame', dynamic_ncols=True))
+    unique_frame_paths = []
+    duplicates = {}
+    reference_signature = None
+    for temp_frame_path, signature in zip(temp_frame_paths, signatures):
+        # compare against the first frame of the run so slow drifts do not chain up
+        if is_duplicate(reference_signature, signature):
+            duplicates[temp_frame_path] = unique_frame_paths[-1]
+        else:
+            unique_frame_paths.append(temp_frame_path)
+            reference_signature = signature
+    count('duplicate', len(duplicates))
+    return unique_frame_paths, duplicates
+
+
+def reuse_duplicate_frames(duplicates: Dict[str, str]) -> None:
+    """Replaces every duplicate with the processed frame it reuses."""
+    for temp_frame_path, reference_frame_path in duplicates.items():
+        shutil.copyfile(reference_frame_path, temp_frame_path)
+
+
+def get_summary() -> str:
+    """Describes how many frames skipped the frame processors."""
+    with STATS_LOCK:
+        if not STATS['frames']:
+            return ''
+        summary = []
+        if modules.globals.skip_faceless:
+            summary.append(f"skipped {STATS['faceless']} without faces ({STATS['faceless'] / STATS['frames']:.1%})")
+        if modules.globals.duplicate_threshold is not None:
+            summary.append(f"reused {STATS['duplicate']} duplicates ({STATS['duplicate'] / STATS['frames']:.1%})")
+        if not summary:
+            return ''
+        return f"Of {STATS['frames']} frames " + ', '.join(summary)
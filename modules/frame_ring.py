@@ -0,0 +1,239 @@
+import queue, subprocess, threading, cv2, numpy as np, modules.globals
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Tuple
+from tqdm import tqdm
+from modules.face_analyser import get_one_face
+from modules.events import watch_progress
+from modules.memory import GOVERNOR
+from modules.frame_filter import STATS, count, is_faceless, reset_stats, get_signature, is_duplicate
+from modules.processors.frame.core import FramePipeline, get_frame_processors_modules
+from modules.typing import Frame
+from modules.utilities import detect_resolution, get_encode_args, open_ffmpeg
+
+# Slot states of the frame ring
+FREE = 0
+DECODED = 1
+PROCESSED = 2
+
+# Settings handed to process workers that do not inherit the parent globals
+PROCESS_WORKER_SETTINGS = ['source_path', 'target_path', 'frame_processors', 'fp_ui', 'many_faces', 'color_correction', 'skip_faceless', 'quantized_models', 'session_optimization', 'session_execution_mode', 'session_threads', 'session_thread_affinity', 'session_memory_arena', 'optimized_cache', 'execution_providers', 'execution_threads', 'log_level']
+
+PROCESS_RING = None
+PROCESS_FRAME_CHAIN = None
+
+
+class FrameRing:
+    """Fixed-size ring of preallocated frame slots in shared memory."""
+
+    def __init__(self, slot_count: int, frame_shape: Tuple[int, int, int], name: str = None) -> None:
+        self.slot_count = slot_count
+        self.frame_shape = tuple(frame_shape)
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=slot_count * int(np.prod(frame_shape)) if self.owner else 0)
+        self.frames = np.ndarray((slot_count,) + self.frame_shape, dtype=np.uint8, buffer=self.memory.buf)
+        self.states = [FREE] * slot_count
+        self.frame_numbers = [-1] * slot_count
+        self.duplicates = [False] * slot_count
+        self.frame_total = None
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def acquire(self, frame_number: int) -> int:
+        """Waits until the slot of the frame is free and claims it, returns -1 when aborted."""
+        slot = frame_number % self.slot_count
+        with self.condition:
+            self.condition.wait_for(lambda: self.aborted or self.states[slot] == FREE)
+            if self.aborted:
+                return -1
+            self.frame_numbers[slot] = frame_number
+        return slot
+
+    def publish(self, slot: int, state: int) -> None:
+        """Moves the slot to the next state and wakes up the waiting stages."""
+        with self.condition:
+            self.states[slot] = state
+            self.condition.notify_all()
+
+    def wait_processed(self, frame_number: int) -> int:
+        """Waits until the frame is processed, returns -1 when the stream ended or was aborted."""
+        slot = frame_number % self.slot_count
+        with self.condition:
+            self.condition.wait_for(lambda: self.aborted or (self.frame_total is not None and frame_number >= self.frame_total) or (self.states[slot] == PROCESSED and self.frame_numbers[slot] == frame_number))
+            if self.aborted or self.states[slot] != PROCESSED or self.frame_numbers[slot] != frame_number:
+                return -1
+        return slot
+
+    def finish(self, frame_total: int) -> None:
+        with self.condition:
+            self.frame_total = frame_total
+            self.condition.notify_all()
+
+    def abort(self) -> None:
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def read_into(stream: Any, frame: Frame) -> bool:
+    """Fills the frame buffer from the stream, returns False at the end of the stream."""
+    view = memoryview(frame).cast('B')
+    total = 0
+    while total < len(view):
+        count = stream.readinto(view[total:])
+        if not count:
+            return False
+        total += count
+    return True
+
+
+def get_frame_chain(source_path: str) -> Callable[[Frame], Frame]:
+    """Returns a callable running every frame processor on a frame."""
+    pipeline = FramePipeline(get_frame_processors_modules(modules.globals.frame_processors), get_one_face(cv2.imread(source_path)))
+    pipeline.init_worker()
+
+    def process_frame(temp_frame: Frame) -> Frame:
+        if modules.globals.skip_faceless and is_faceless(temp_frame):
+            return temp_frame
+        return pipeline.process([temp_frame])[0]
+    return process_frame
+
+
+def process_slot(frame: Frame, process_frame: Callable[[Frame], Frame]) -> None:
+    result = process_frame(frame)
+    if result is not frame:
+        np.copyto(frame, result)
+
+
+def init_process_worker(memory_name: str, slot_count: int, frame_shape: Tuple[int, int, int], settings: Dict[str, Any]) -> None:
+    global PROCESS_RING, PROCESS_FRAME_CHAIN
+
+    for name, value in settings.items():
+        setattr(modules.globals, name, value)
+    PROCESS_RING = FrameRing(slot_count, frame_shape, memory_name)
+    PROCESS_FRAME_CHAIN = get_frame_chain(modules.globals.source_path)
+
+
+def process_ring_slot(slot: int) -> Dict[str, int]:
+    """Processes the slot in a worker process and returns its frame filter counters."""
+    reset_stats()
+    process_slot(PROCESS_RING.frames[slot], PROCESS_FRAME_CHAIN)
+    return dict(STATS)
+
+
+def encode(ring: FrameRing, encoder: subprocess.Popen, progress: Any) -> None:
+    """Drains processed slots into the encoder in frame order."""
+    # duplicates repeat the last encoded output, kept in one preallocated buffer
+    last_output = np.empty(ring.frame_shape, dtype=np.uint8) if modules.globals.duplicate_threshold is not None else None
+    frame_number = 0
+    while True:
+        slot = ring.wait_processed(frame_number)
+        if slot < 0:
+            break
+        if ring.duplicates[slot]:
+            encoder.stdin.write(last_output)
+        else:
+            encoder.stdin.write(ring.frames[slot])
+            if last_output is not None:
+                np.copyto(last_output, ring.frames[slot])
+        ring.publish(slot, FREE)
+        progress.update(1)
+        frame_number += 1
+
+
+def process_video_stream(source_path: str, target_path: str, output_path: str, fps: float = 30.0, input_args: List[str] = None, frame_limit: int = None, slot_count: int = None, worker_total: int = None, progress: Any = None, screen: Any = None, convert_colorspace: bool = True, repeat_headers: bool = False) -> bool:
+    """Decodes, processes and encodes the target through the frame ring without temp frames, aborting when the screen finds NSFW content."""
+    width, height = detect_resolution(target_path)
+    ring = FrameRing(slot_count or modules.globals.frame_ring_size, (height, width, 3))
+    worker_total = worker_total or modules.globals.execution_threads
+    executor = None
+    process_frame = None
+    if modules.globals.frame_ring_workers == 'process':
+        settings = {name: getattr(modules.globals, name) for name in PROCESS_WORKER_SETTINGS}
+        executor = ProcessPoolExecutor(max_workers=worker_total, initializer=init_process_worker, initargs=(ring.memory.name, ring.slot_count, ring.frame_shape, settings))
+    else:
+        process_frame = get_frame_chain(source_path)
+    decoder = open_ffmpeg((input_args or []) + ['-i', target_path] + (['-frames:v', str(frame_limit)] if frame_limit else []) + ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=subprocess.PIPE)
+    encoder = open_ffmpeg(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-'] + get_encode_args(output_path, convert_colorspace, repeat_headers), stdin=subprocess.PIPE)
+    work_queue: queue.Queue = queue.Queue()
+
+    def decode() -> None:
+        frame_number = 0
+        reference_signature = None
+        while True:
+            slot = ring.acquire(frame_number)
+            if slot < 0 or not read_into(decoder.stdout, ring.frames[slot]):
+                break
+            count('frames')
+            if screen is not None and screen.feed(ring.frames[slot]):
+                ring.abort()
+                break
+            if modules.globals.duplicate_threshold is not None:
+                signature = get_signature(ring.frames[slot])
+                ring.duplicates[slot] = is_duplicate(reference_signature, signature)
+                if ring.duplicates[slot]:
+                    count('duplicate')
+                    ring.publish(slot, PROCESSED)
+                    frame_number += 1
+                    continue
+                reference_signature = signature
+            GOVERNOR.enter()
+            ring.publish(slot, DECODED)
+            work_queue.put(slot)
+            frame_number += 1
+        ring.finish(frame_number)
+        for _ in range(worker_total):
+            work_queue.put(None)
+
+    def work() -> None:
+        while True:
+            slot = work_queue.get()
+            if slot is None:
+                return
+            try:
+                if executor:
+                    for name, amount in executor.submit(process_ring_slot, slot).result().items():
+                        count(name, amount)
+                else:
+                    process_slot(ring.frames[slot], process_frame)
+            except Exception as exception:
+                print(exception)
+            ring.publish(slot, PROCESSED)
+            GOVERNOR.leave()
+
+    threads = [threading.Thread(target=decode, daemon=True)] + [threading.Thread(target=work, daemon=True) for _ in range(worker_total)]
+    for thread in threads:
+        thread.start()
+    completed = False
+    try:
+        if progress is not None:
+            encode(ring, encoder, progress)
+        else:
+            with tqdm(desc='Processing', unit='frame', dynamic_ncols=True) as progress:
+                progress.set_postfix({'execution_providers': modules.globals.execution_providers,
+                                      'execution_threads': modules.globals.execution_threads,
+                                      'frame_ring_size': ring.slot_count})
+                watch_progress(progress)
+                encode(ring, encoder, progress)
+        completed = not ring.aborted
+    except (BrokenPipeError, KeyboardInterrupt):
+        ring.abort()
+    finally:
+        encoder.stdin.close()
+        if ring.aborted:
+            decoder.kill()
+        ring.abort()
+        for thread in threads:
+            thread.join()
+        decoder.stdout.close()
+        decoder.wait()
+        if executor:
+            executor.shutdown()
+        ring.close()
+    return encoder.wait() == 0 and completed
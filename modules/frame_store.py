@@ -0,0 +1,108 @@
+import glob, os, shutil, sys, tempfile, time, cv2, numpy as np, modules.globals
+from typing import Any, Dict, List
+from modules.typing import Frame
+
+# Intermediate formats for the temp frames between extraction, processing and encoding
+TEMP_FRAME_FORMATS = ['png', 'bmp', 'npy']
+
+
+def get_temp_frame_format() -> str:
+    """Returns the configured intermediate frame format."""
+    return modules.globals.temp_frame_format or 'png'
+
+
+def get_temp_frame_compression() -> int:
+    """Returns the PNG compression level used for intermediate frames."""
+    return modules.globals.temp_frame_compression if modules.globals.temp_frame_compression is not None else 1
+
+
+def get_frame_name(index: int, frame_format: str = None) -> str:
+    """Returns the file name of the frame at the given (1-based) index."""
+    return f'{index:04d}.{frame_format or get_temp_frame_format()}'
+
+
+def get_frame_pattern(directory_path: str, frame_format: str = None) -> str:
+    """Returns the printf style pattern ffmpeg uses for the frame sequence."""
+    return os.path.join(directory_path, f'%04d.{frame_format or get_temp_frame_format()}')
+
+
+def get_frame_number(frame_path: str) -> int:
+    """Returns the frame number from the name of a frame written with the frame pattern."""
+    return int(os.path.splitext(os.path.basename(frame_path))[0])
+
+
+def get_frame_paths(directory_path: str, frame_format: str = None) -> List[str]:
+    """Returns the frame paths inside the directory in frame order."""
+    frame_paths = glob.glob(os.path.join(glob.escape(directory_path), f'*.{frame_format or get_temp_frame_format()}'))
+    # the names outgrow their zero padding past 9999 frames, so they are ordered by number and not as strings
+    return sorted(frame_paths, key=get_frame_number)
+
+
+def get_extract_args(directory_path: str) -> List[str]:
+    """Returns the ffmpeg output arguments to write the frame sequence in the configured format."""
+    frame_format = get_temp_frame_format()
+    if frame_format == 'bmp':
+        return ['-pix_fmt', 'bgr24', get_frame_pattern(directory_path)]
+    return ['-pix_fmt', 'rgb24', '-compression_level', str(get_temp_frame_compression()), get_frame_pattern(directory_path)]
+
+
+def read_frame(frame_path: str) -> Frame:
+    """Reads an intermediate frame, memory mapping raw frames instead of decoding them."""
+    if frame_path.endswith('.npy'):
+        return np.load(frame_path, mmap_mode='c')
+    return cv2.imread(frame_path)
+
+
+def write_frame(frame_path: str, frame: Frame) -> bool:
+    """Writes an intermediate frame in the format given by its extension."""
+    if frame_path.endswith('.npy'):
+        memmap = np.load(frame_path, mmap_mode='r+') if os.path.isfile(frame_path) else None
+        # overwrite in place so copy-on-write maps handed out by read_frame stay valid
+        if memmap is None or memmap.shape != frame.shape or memmap.dtype != np.uint8:
+            del memmap
+            memmap = np.lib.format.open_memmap(frame_path, mode='w+', dtype=np.uint8, shape=frame.shape)
+        memmap[:] = frame
+        memmap.flush()
+        del memmap
+        return True
+    if frame_path.endswith('.png'):
+        return cv2.imwrite(frame_path, frame, [cv2.IMWRITE_PNG_COMPRESSION, get_temp_frame_compression()])
+    return cv2.imwrite(frame_path, frame)
+
+
+def benchmark(frame: Frame, count: int = 50) -> Dict[str, Dict[str, Any]]:
+    """Compares disk usage against write and read throughput for every intermediate format."""
+    results = {}
+    frame_formats = [('png', level) for level in (0, 1, 3, 9)] + [('bmp', None), ('npy', None)]
+    for frame_format, level in frame_formats:
+        directory_path = tempfile.mkdtemp(prefix='dlc-frame-store-')
+        previous_compression = modules.globals.temp_frame_compression
+        modules.globals.temp_frame_compression = level
+        try:
+            frame_paths = [os.path.join(directory_path, get_frame_name(index + 1, frame_format)) for index in range(count)]
+            start_time = time.perf_counter()
+            for frame_path in frame_paths:
+                write_frame(frame_path, frame)
+            write_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            for frame_path in frame_paths:
+                np.asarray(read_frame(frame_path)).sum()
+            read_time = time.perf_counter() - start_time
+            name = frame_format if level is None else f'{frame_format}-{level}'
+            results[name] = {
+                'bytes_per_frame': sum(os.path.getsize(frame_path) for frame_path in frame_paths) // count,
+                'write_fps': count / write_time,
+                'read_fps': count / read_time
+            }
+        finally:
+            modules.globals.temp_frame_compression = previous_compression
+            shutil.rmtree(directory_path, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python -m modules.frame_store <image> [count]')
+        sys.exit(1)
+    for name, result in benchmark(cv2.imread(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 50).items():
+        print(f"{name:>6}: {result['bytes_per_frame'] / 1024 ** 2:8.2f} MB/frame  write {result['write_fps']:7.1f} fps  read {result['read_fps']:7.1f} fps")
@@ -13,7 +13,7 @@ file_types = [
 
 # Source to target mappings
 source_target_map: List[Dict[str, Any]] = []
-simple_map: Dict[str, str] = {}
+simple_map: Dict[str, Any] = {}
 
 # Paths for source, target, and output
 source_path: str = None
@@ -31,20 +31,48 @@ many_faces: bool = None
 map_faces: bool = None
 color_correction: bool = None  # Toggle for color correction
 nsfw_filter: bool = None
+nsfw_interval: int = 100
+skip_faceless: bool = False
+duplicate_threshold: float = None
 
 # Video encoding settings
+smart_render: bool = False
 video_encoder: str = None
 video_quality: str = None
 
+# Intermediate frame settings
+temp_frame_format: str = 'png'
+temp_frame_compression: int = 1
+frame_ring_size: int = 0
+frame_ring_workers: str = 'thread'
+segment_jobs: int = 1
+segment_retries: int = 1
+
+# Sharded rendering through a shared work directory
+shard_dir: str = None
+shard_role: str = 'worker'
+shard_count: int = 8
+
 # Live stream options
 live_mirror: bool = None
 live_resizable: bool = None
+live_recheck_interval: int = 30
+live_sinks: List[str] = []
 
 # System and execution settings
+model_mirror: str = None
+quantized_models: bool = False
+session_optimization: str = 'all'
+session_execution_mode: str = 'sequential'
+session_threads: int = 0
+session_memory_arena: bool = True
+session_thread_affinity: str = None
+optimized_cache: bool = True
 max_memory: int = None
 execution_providers: List[str] = []
 execution_threads: int = None
 headless: bool = None
+event_stream: str = None
 
 # Logging level
 log_level: str = 'error'
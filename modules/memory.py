@@ -0,0 +1,93 @@
+import gc, threading, time, psutil, modules.globals
+from typing import Callable, List
+
+NAME = 'DLC.MEMORY'
+# Share of the budget at which the in-flight window shrinks and caches are dropped
+MEMORY_HIGH_WATER = 0.85
+# Share of the budget below which the in-flight window grows back
+MEMORY_LOW_WATER = 0.7
+MEMORY_CHECK_INTERVAL = 0.5
+MAX_WINDOW = 64
+
+
+def get_budget() -> int:
+    return modules.globals.max_memory * 1024 ** 3 if modules.globals.max_memory else 0
+
+
+def get_usage() -> int:
+    """Returns the resident memory of this process and its children, which include the ffmpeg pipes and process workers."""
+    process = psutil.Process()
+    usage = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            usage += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return usage
+
+
+def format_size(size: int) -> str:
+    return f'{size / 1024 ** 3:.1f} GB'
+
+
+class MemoryGovernor:
+    """Keeps the job inside the memory budget by bounding the frames in flight and dropping caches under pressure."""
+
+    def __init__(self) -> None:
+        self.window = MAX_WINDOW
+        self.in_flight = 0
+        self.checked = 0.0
+        self.releases: List[Callable[[], None]] = []
+        self.condition = threading.Condition()
+
+    def register_release(self, release: Callable[[], None]) -> None:
+        """Adds a cache to drop when memory runs short."""
+        self.releases.append(release)
+
+    def release(self) -> None:
+        for release in self.releases:
+            release()
+        gc.collect()
+
+    def check(self) -> None:
+        """Adapts the in-flight window to the current usage, at most once per check interval."""
+        budget = get_budget()
+        now = time.monotonic()
+        if not budget or now - self.checked < MEMORY_CHECK_INTERVAL:
+            return
+        self.checked = now
+        usage = get_usage()
+        if usage >= budget * MEMORY_HIGH_WATER:
+            # the caches were dropped on the way down to one frame, dropping them again only costs collections
+            if self.window == 1:
+                return
+            self.release()
+            window = max(1, min(self.window, self.in_flight) // 2)
+            if window < self.window:
+                print(f'[{NAME}] {format_size(usage)} of {format_size(budget)} in use, dropped caches and limited the frames in flight from {self.window} to {window}')
+            self.window = window
+        elif usage < budget * MEMORY_LOW_WATER and self.window < MAX_WINDOW:
+            self.window += 1
+            self.condition.notify_all()
+
+    def enter(self, frame_total: int = 1) -> None:
+        """Waits until the frames fit into the in-flight window."""
+        with self.condition:
+            self.check()
+            # frames are always allowed when none are in flight, so the job slows down instead of stalling
+            while self.in_flight and self.in_flight + frame_total > self.window:
+                self.condition.wait(MEMORY_CHECK_INTERVAL)
+                self.check()
+            self.in_flight += frame_total
+
+    def leave(self, frame_total: int = 1) -> None:
+        with self.condition:
+            self.in_flight -= frame_total
+            self.condition.notify_all()
+
+
+GOVERNOR = MemoryGovernor()
+
+
+def register_release(release: Callable[[], None]) -> None:
+    GOVERNOR.register_release(release)
@@ -0,0 +1,197 @@
+import hashlib, http.client, json, os, shutil, time, urllib.error, urllib.request, modules.globals
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+# Known models by file name, a sha256 pins the content. Entries without one still need their digest taken from a trusted
+# copy, until then the hash of the first complete download is recorded and reported so it can be compared and pinned
+MODELS: Dict[str, Dict[str, Optional[str]]] = {
+    'inswapper_128_fp16.onnx': {'url': 'https://huggingface.co/hacksider/deep-live-cam/resolve/main/inswapper_128_fp16.onnx', 'sha256': None},
+    'GFPGANv1.4.pth': {'url': 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth', 'sha256': None}
+}
+DOWNLOAD_CONNECTIONS = 4
+# Files below twice this size are fetched over a single connection
+DOWNLOAD_SPLIT_SIZE = 16 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+BLOCK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_model_url(name: str) -> str:
+    return MODELS[name]['url']
+
+
+def get_record_path(file_path: str) -> str:
+    return f'{file_path}.sha256.json'
+
+
+def hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_record(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(get_record_path(file_path)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_record(file_path: str, sha256: str) -> None:
+    stat = os.stat(file_path)
+    with open(get_record_path(file_path), 'w') as file:
+        json.dump({'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime}, file)
+
+
+def verify_model(file_path: str, sha256: Optional[str] = None, size: Optional[int] = None) -> bool:
+    """Checks the model against the pinned hash or the hash recorded when it was downloaded."""
+    if not os.path.isfile(file_path):
+        return False
+    stat = os.stat(file_path)
+    if size and stat.st_size != size:
+        return False
+    record = read_record(file_path)
+    if record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+        return sha256 is None or record['sha256'] == sha256
+    actual_sha256 = hash_file(file_path)
+    if (sha256 or (record or {}).get('sha256', actual_sha256)) != actual_sha256:
+        return False
+    write_record(file_path, actual_sha256)
+    return True
+
+
+def open_url(url: str, start: int = 0, end: Optional[int] = None) -> Any:
+    request = urllib.request.Request(url)
+    if start or end is not None:
+        request.add_header('Range', f"bytes={start}-{'' if end is None else end}")
+    return urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+
+def probe_url(url: str) -> Tuple[Optional[int], bool]:
+    """Returns the size of the remote file and whether the server serves byte ranges."""
+    try:
+        with open_url(url, 0, 0) as response:
+            if response.status == 206:
+                return int(response.headers['Content-Range'].rpartition('/')[2]), True
+            length = response.headers.get('Content-Length')
+            return (int(length) if length else None), False
+    # malformed responses are download failures like any other
+    except (http.client.HTTPException, ValueError, AttributeError) as exception:
+        raise DownloadError(f'Probing {url} failed: {exception}') from exception
+
+
+def fetch_range(url: str, part_path: str, start: int, end: Optional[int], progress: Any) -> None:
+    """Appends the byte range to the part file, resuming after what a previous attempt already wrote."""
+    for attempt in range(DOWNLOAD_RETRIES):
+        done = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        if end is not None and start + done > end:
+            return
+        try:
+            with open_url(url, start + done, end) as response:
+                mode = 'ab'
+                if response.status != 206 and start + done:
+                    if start:
+                        raise DownloadError(f'{url} stopped serving byte ranges')
+                    # a server ignoring the range sends everything again
+                    mode = 'wb'
+                    progress.update(-done)
+                with open(part_path, mode) as file:
+                    for block in iter(lambda: response.read(BLOCK_SIZE), b''):
+                        file.write(block)
+                        progress.update(len(block))
+                # a dropped connection ends the body early without raising
+                if response.length:
+                    raise ConnectionError(f'connection closed with {response.length} bytes left')
+            return
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as exception:
+            if attempt + 1 == DOWNLOAD_RETRIES:
+                raise DownloadError(f'Downloading {url} failed: {exception}') from exception
+            time.sleep(2 ** attempt)
+
+
+def fetch(url: str, part_path: str, size: Optional[int], ranged: bool, progress: Any, split_size: int = DOWNLOAD_SPLIT_SIZE) -> None:
+    """Downloads into the part file, in parallel byte ranges when the server supports them and the file is at least twice the split size."""
+    if not ranged or not size or size < 2 * split_size:
+        if not ranged and os.path.isfile(part_path):
+            os.remove(part_path)
+        progress.update(os.path.getsize(part_path) if os.path.isfile(part_path) else 0)
+        fetch_range(url, part_path, 0, None, progress)
+        return
+    chunk_size = -(-size // DOWNLOAD_CONNECTIONS)
+    chunks = [(index, start, min(start + chunk_size, size) - 1) for index, start in enumerate(range(0, size, chunk_size))]
+    chunk_paths = [f'{part_path}.{index}' for index, _, _ in chunks]
+    progress.update(sum(os.path.getsize(chunk_path) for chunk_path in chunk_paths if os.path.isfile(chunk_path)))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONNECTIONS) as executor:
+        for future in [executor.submit(fetch_range, url, chunk_path, start, end, progress) for (_, start, end), chunk_path in zip(chunks, chunk_paths)]:
+            future.result()
+    with open(part_path, 'wb') as file:
+        for chunk_path in chunk_paths:
+            with open(chunk_path, 'rb') as chunk_file:
+                shutil.copyfileobj(chunk_file, file, BLOCK_SIZE)
+    for chunk_path in chunk_paths:
+        os.remove(chunk_path)
+
+
+def download_model(url: str, file_path: str, sha256: Optional[str] = None, split_size: int = DOWNLOAD_SPLIT_SIZE) -> None:
+    """Downloads or copies the model from the mirror, verifies it and moves it into place atomically."""
+    part_path = f'{file_path}.part'
+    name = os.path.basename(file_path)
+    mirror_path = os.path.join(modules.globals.model_mirror, name) if modules.globals.model_mirror else None
+    if mirror_path and os.path.isfile(mirror_path):
+        shutil.copyfile(mirror_path, part_path)
+        size = None
+    else:
+        size, ranged = probe_url(url)
+        with tqdm(total=size, desc=f'Downloading {name}', unit='B', unit_scale=True, unit_divisor=1024) as progress:
+            fetch(url, part_path, size, ranged, progress, split_size)
+    actual_sha256 = hash_file(part_path)
+    if (size and os.path.getsize(part_path) != size) or (sha256 and actual_sha256 != sha256):
+        os.remove(part_path)
+        raise DownloadError(f'{name} is corrupt, expected {sha256 or f"{size} bytes"}')
+    if not sha256:
+        print(f'[DLC.MODELS] {name} has no pinned sha256, trusting this download with {actual_sha256}')
+    os.replace(part_path, file_path)
+    write_record(file_path, actual_sha256)
+
+
+def is_complete(url: str, file_path: str, sha256: Optional[str]) -> bool:
+    """Checks an existing model, a file without record is compared with the remote size when online."""
+    if not os.path.isfile(file_path):
+        return False
+    size = None
+    if not sha256 and read_record(file_path) is None:
+        try:
+            size = probe_url(url)[0]
+        except (DownloadError, urllib.error.URLError, OSError):
+            pass
+    return verify_model(file_path, sha256, size)
+
+
+def ensure_models(download_directory_path: str, urls: List[str]) -> bool:
+    """Makes sure every model is present and intact, downloading the missing ones in parallel."""
+    os.makedirs(download_directory_path, exist_ok=True)
+
+    def ensure(url: str) -> None:
+        file_path = os.path.join(download_directory_path, os.path.basename(url))
+        sha256 = MODELS.get(os.path.basename(url), {}).get('sha256')
+        if not is_complete(url, file_path, sha256):
+            download_model(url, file_path, sha256)
+
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        futures = [executor.submit(ensure, url) for url in urls]
+    try:
+        for future in futures:
+            future.result()
+    except (DownloadError, urllib.error.URLError, OSError) as exception:
+        print(f'[DLC.MODELS] {exception}')
+        return False
+    return True
+
@@ -0,0 +1,140 @@
+import asyncio, os, cv2, numpy as np, modules.globals
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+from tqdm import tqdm
+from modules.events import watch_progress
+from modules.face_analyser import get_one_face
+from modules.frame_filter import count, is_faceless
+from modules.frame_store import get_extract_args, get_frame_name, read_frame
+from modules.memory import GOVERNOR
+from modules.processors.frame.core import FRAME_BATCH_SIZE, FramePipeline, get_frame_processors_modules
+from modules.typing import Frame
+from modules.utilities import detect_resolution, get_encode_args, get_temp_directory_path
+
+NAME = 'DLC.ORCHESTRATOR'
+
+
+async def start_ffmpeg(args: List[str], **kwargs: Any) -> asyncio.subprocess.Process:
+    """Starts ffmpeg reporting its progress as key=value lines on stderr."""
+    return await asyncio.create_subprocess_exec('ffmpeg', '-hide_banner', '-hwaccel', 'auto', '-loglevel', modules.globals.log_level, '-nostats', '-progress', 'pipe:2', *args, stderr=asyncio.subprocess.PIPE, **kwargs)
+
+
+async def stream_progress(process: asyncio.subprocess.Process, on_frame: Callable[[int], Any]) -> None:
+    """Reads the progress of ffmpeg until it exits, calling back with the number of frames done."""
+    async for line in process.stderr:
+        key, _, value = line.decode(errors='ignore').strip().partition('=')
+        if key == 'frame' and value.isdigit():
+            await on_frame(int(value))
+
+
+async def orchestrate(source_path: str, target_path: str, output_path: str, fps: float, frame_total: int, screen: Any = None, audio: bool = False) -> bool:
+    """Extracts, processes and encodes the target at the same time, each stage consuming what the previous one finished."""
+    loop = asyncio.get_running_loop()
+    temp_directory_path = get_temp_directory_path(target_path)
+    width, height = detect_resolution(target_path)
+    pipeline = FramePipeline(get_frame_processors_modules(modules.globals.frame_processors), get_one_face(cv2.imread(source_path)))
+    executor = ThreadPoolExecutor(max_workers=modules.globals.execution_threads, initializer=pipeline.init_worker)
+    extraction = {'frames': 0, 'done': False}
+    extracted = asyncio.Condition()
+    batches: asyncio.Queue = asyncio.Queue(maxsize=2 * modules.globals.execution_threads)
+    aborted = asyncio.Event()
+    status = {'extracted': 0, 'encoded': 0, 'execution_threads': modules.globals.execution_threads}
+    audio_args = ['-i', target_path, '-map', '0:v:0', '-map', '1:a:0'] if audio else []
+    # frames are renamed into place once complete, so an existing file is always a whole frame
+    extractor = await start_ffmpeg(['-i', target_path, '-atomic_writing', '1'] + get_extract_args(temp_directory_path))
+    encoder = await start_ffmpeg(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-'] + audio_args + get_encode_args(output_path), stdin=asyncio.subprocess.PIPE)
+
+    def abort() -> None:
+        aborted.set()
+        for process in (extractor, encoder):
+            if process.returncode is None:
+                process.kill()
+
+    def process_batch(frame_numbers: List[int]) -> List[Frame]:
+        frames = [read_frame(os.path.join(temp_directory_path, get_frame_name(frame_number))) for frame_number in frame_numbers]
+        count('frames', len(frames))
+        if screen is not None and any([screen.feed(frame) for frame in frames]):
+            loop.call_soon_threadsafe(abort)
+        faced = [index for index, frame in enumerate(frames) if not is_faceless(frame)] if modules.globals.skip_faceless else list(range(len(frames)))
+        # like the other paths, a failing batch is reported and its frames are encoded unprocessed
+        try:
+            for index, frame in zip(faced, pipeline.process([frames[index] for index in faced])):
+                frames[index] = frame
+        except Exception as exception:
+            print(f'[{NAME}] {exception}')
+        return frames
+
+    def count_extracted(frame_total: int = None) -> None:
+        # ffmpeg counts a frame when it is queued to its muxer, the file may follow a little later
+        while (frame_total is None or extraction['frames'] < frame_total) and os.path.isfile(os.path.join(temp_directory_path, get_frame_name(extraction['frames'] + 1))):
+            extraction['frames'] += 1
+
+    async def on_extracted(frame_number: int) -> None:
+        async with extracted:
+            count_extracted(frame_number)
+            status['extracted'] = extraction['frames']
+            progress.set_postfix(status, refresh=False)
+            extracted.notify_all()
+
+    async def on_encoded(frame_number: int) -> None:
+        status['encoded'] = frame_number
+        progress.set_postfix(status, refresh=False)
+
+    async def extract() -> None:
+        await stream_progress(extractor, on_extracted)
+        await extractor.wait()
+        async with extracted:
+            # the last progress report may lag behind the frames written
+            count_extracted()
+            extraction['done'] = True
+            extracted.notify_all()
+
+    async def schedule() -> None:
+        frame_number = 1
+        while not aborted.is_set():
+            async with extracted:
+                await extracted.wait_for(lambda: extraction['done'] or extraction['frames'] >= frame_number + FRAME_BATCH_SIZE - 1)
+                last_frame_number = min(extraction['frames'], frame_number + FRAME_BATCH_SIZE - 1)
+            if last_frame_number < frame_number:
+                break
+            frame_numbers = list(range(frame_number, last_frame_number + 1))
+            # the memory governor counts every frame of the batch
+            await loop.run_in_executor(None, GOVERNOR.enter, len(frame_numbers))
+            await batches.put((len(frame_numbers), loop.run_in_executor(executor, process_batch, frame_numbers)))
+            frame_number = last_frame_number + 1
+        await batches.put(None)
+
+    async def encode() -> None:
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            frame_total, batch = batch
+            try:
+                frames = await batch
+                if not aborted.is_set():
+                    for frame in frames:
+                        encoder.stdin.write(np.ascontiguousarray(frame).data.cast('B'))
+                    await encoder.stdin.drain()
+                progress.update(len(frames))
+            except (BrokenPipeError, ConnectionResetError):
+                abort()
+            except Exception as exception:
+                print(f'[{NAME}] {exception}')
+                abort()
+            finally:
+                GOVERNOR.leave(frame_total)
+        encoder.stdin.close()
+
+    with tqdm(total=frame_total or None, desc='Processing', unit='frame', dynamic_ncols=True) as progress:
+        watch_progress(progress)
+        try:
+            await asyncio.gather(extract(), schedule(), encode(), stream_progress(encoder, on_encoded))
+        finally:
+            executor.shutdown()
+    return await encoder.wait() == 0 and await extractor.wait() == 0 and not aborted.is_set()
+
+
+def process_video_orchestrated(source_path: str, target_path: str, output_path: str, fps: float, frame_total: int, screen: Any = None, audio: bool = False) -> bool:
+    """Runs the extraction, the frame processors and the encoder concurrently, muxing the audio of the target when asked."""
+    return asyncio.run(orchestrate(source_path, target_path, output_path, fps, frame_total, screen, audio))
@@ -1,12 +1,65 @@
-import numpy as np, opennsfw2, cv2, modules.globals
+import hashlib, json, os, threading, numpy as np, opennsfw2, cv2, modules.globals
 from PIL import Image
+from typing import Any, Dict, List, Optional, Tuple
+from modules.frame_store import read_frame
 from modules.typing import Frame
+from modules.utilities import resolve_relative_path
 
 # Threshold for NSFW content probability
 MAX_PROBABILITY = 0.85
 
+# Number of sampled frames scored per model call
+BATCH_SIZE = 16
+
+# Verdicts by target content, so repeated runs on the same target skip the check
+VERDICT_CACHE_PATH = resolve_relative_path('../models/nsfw_verdicts.json')
+VERDICT_CACHE_LOCK = threading.Lock()
+CONTENT_HASHES: Dict[Tuple[str, float, int], str] = {}
+
 # Preload the NSFW model for efficiency
 model = None
+MODEL_LOCK = threading.Lock()
+
+def get_model() -> Any:
+    """
+    Loads the NSFW model once.
+
+    Returns:
+        The Keras model of opennsfw2.
+    """
+    global model
+    with MODEL_LOCK:
+        if model is None:
+            model = opennsfw2.make_open_nsfw_model()
+    return model
+
+def prepare_frame(target_frame: Frame) -> np.ndarray:
+    """
+    Preprocesses a frame for the NSFW model.
+
+    Args:
+        target_frame (Frame): The image frame to be analyzed.
+
+    Returns:
+        np.ndarray: The model input, downscaled before the PIL round trip to keep it cheap.
+    """
+    # frames of the pipeline are BGR, the model was trained on RGB images
+    image = Image.fromarray(cv2.cvtColor(cv2.resize(np.asarray(target_frame), (256, 256), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB))
+    return opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
+
+def predict_views(views: List[np.ndarray]) -> List[float]:
+    """
+    Scores preprocessed frames in batches.
+
+    Args:
+        views (List[np.ndarray]): Frames returned by prepare_frame.
+
+    Returns:
+        List[float]: The NSFW probability of every frame.
+    """
+    if not views:
+        return []
+    return [float(probability) for _, probability in get_model().predict(np.stack(views), batch_size=BATCH_SIZE, verbose=0)]
 
 def predict_frame(target_frame: Frame) -> bool:
     """
@@ -18,23 +71,71 @@ def predict_frame(target_frame: Frame) -> bool:
     Returns:
         bool: True if NSFW content probability exceeds the threshold, False otherwise.
     """
-    global model
-    # Apply color correction if enabled
-    if modules.globals.color_correction:
-        target_frame = cv2.cvtColor(target_frame, cv2.COLOR_BGR2RGB)
-    
-    # Convert frame to PIL image and preprocess
-    image = Image.fromarray(target_frame)
-    image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
-    
-    # Load model if not already loaded
-    if model is None:
-        model = opennsfw2.make_open_nsfw_model()
-
-    # Predict and return NSFW likelihood
-    views = np.expand_dims(image, axis=0)
-    _, probability = model.predict(views)[0]
-    return probability > MAX_PROBABILITY
+    return predict_views([prepare_frame(target_frame)])[0] > MAX_PROBABILITY
+
+def get_content_hash(target_path: str) -> str:
+    """
+    Hashes the content of a file, memoized by path, modification time and size.
+
+    Args:
+        target_path (str): Path to the file.
+
+    Returns:
+        str: The sha256 hex digest of the file content.
+    """
+    stat = os.stat(target_path)
+    key = (os.path.abspath(target_path), stat.st_mtime, stat.st_size)
+    if key not in CONTENT_HASHES:
+        digest = hashlib.sha256()
+        with open(target_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        CONTENT_HASHES[key] = digest.hexdigest()
+    return CONTENT_HASHES[key]
+
+def get_verdict_key(target_path: str, interval: int = 0) -> str:
+    return f'{get_content_hash(target_path)}:{MAX_PROBABILITY}:{interval}'
+
+def load_verdicts() -> Dict[str, bool]:
+    try:
+        with open(VERDICT_CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def get_cached_verdict(target_path: str, interval: int = 0) -> Optional[bool]:
+    """
+    Looks up the cached verdict of a target.
+
+    Args:
+        target_path (str): Path to the image or video file.
+        interval (int): Frame sampling interval the verdict was made with, 0 for images.
+
+    Returns:
+        Optional[bool]: The cached verdict, None if the target was not checked yet.
+    """
+    if not target_path or not os.path.isfile(target_path):
+        return None
+    with VERDICT_CACHE_LOCK:
+        return load_verdicts().get(get_verdict_key(target_path, interval))
+
+def cache_verdict(target_path: str, verdict: bool, interval: int = 0) -> None:
+    """
+    Stores the verdict of a target.
+
+    Args:
+        target_path (str): Path to the image or video file.
+        verdict (bool): True if the target is NSFW.
+        interval (int): Frame sampling interval the verdict was made with, 0 for images.
+    """
+    with VERDICT_CACHE_LOCK:
+        verdicts = load_verdicts()
+        verdicts[get_verdict_key(target_path, interval)] = verdict
+        os.makedirs(os.path.dirname(VERDICT_CACHE_PATH), exist_ok=True)
+        temp_path = f'{VERDICT_CACHE_PATH}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(verdicts, file)
+        os.replace(temp_path, VERDICT_CACHE_PATH)
 
 def predict_image(target_path: str) -> bool:
     """
@@ -46,7 +147,11 @@ def predict_image(target_path: str) -> bool:
     Returns:
         bool: True if NSFW content probability exceeds the threshold, False otherwise.
     """
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+    verdict = get_cached_verdict(target_path)
+    if verdict is None:
+        verdict = opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+        cache_verdict(target_path, verdict)
+    return verdict
 
 def predict_video(target_path: str) -> bool:
     """
@@ -58,5 +163,84 @@ def predict_video(target_path: str) -> bool:
     Returns:
         bool: True if any frame exceeds the NSFW probability threshold, False otherwise.
     """
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
-    return any(prob > MAX_PROBABILITY for prob in probabilities)
+    verdict = get_cached_verdict(target_path, modules.globals.nsfw_interval)
+    if verdict is None:
+        _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=modules.globals.nsfw_interval)
+        verdict = any(prob > MAX_PROBABILITY for prob in probabilities)
+        cache_verdict(target_path, verdict, modules.globals.nsfw_interval)
+    return verdict
+
+class NsfwScreen:
+    """
+    Screens a video on frames tapped from the main decode stream instead of decoding it again.
+
+    Every interval-th frame fed is scored, in batches, and the verdict is cached by target content.
+    """
+
+    def __init__(self, target_path: str) -> None:
+        self.target_path = target_path
+        self.interval = modules.globals.nsfw_interval
+        self.verdict = get_cached_verdict(target_path, self.interval)
+        self.cached = self.verdict is not None
+        self.views: List[np.ndarray] = []
+        self.frame_count = 0
+        self.lock = threading.Lock()
+
+    def score(self) -> None:
+        if any(probability > MAX_PROBABILITY for probability in predict_views(self.views)):
+            self.verdict = True
+        self.views = []
+
+    def feed(self, frame: Frame) -> bool:
+        """
+        Taps a decoded frame.
+
+        Args:
+            frame (Frame): The next frame of the stream.
+
+        Returns:
+            bool: True once the target is found to be NSFW.
+        """
+        with self.lock:
+            if self.verdict is None:
+                if self.frame_count % self.interval == 0:
+                    self.views.append(prepare_frame(frame))
+                self.frame_count += 1
+                if len(self.views) >= BATCH_SIZE:
+                    self.score()
+            return bool(self.verdict)
+
+    def feed_frame_paths(self, temp_frame_paths: List[str]) -> bool:
+        """
+        Taps the extracted frames, reading only the sampled ones.
+
+        Args:
+            temp_frame_paths (List[str]): The extracted frames in order.
+
+        Returns:
+            bool: True if the target is NSFW.
+        """
+        for temp_frame_path in temp_frame_paths[::self.interval]:
+            with self.lock:
+                if self.verdict is not None:
+                    break
+                self.views.append(prepare_frame(read_frame(temp_frame_path)))
+                if len(self.views) >= BATCH_SIZE:
+                    self.score()
+        return self.finish()
+
+    def finish(self) -> bool:
+        """
+        Scores the remaining samples and caches the verdict.
+
+        Returns:
+            bool: True if the target is NSFW.
+        """
+        with self.lock:
+            if self.verdict is None:
+                self.score()
+                self.verdict = bool(self.verdict)
+            if not self.cached:
+                cache_verdict(self.target_path, self.verdict, self.interval)
+                self.cached = True
+            return self.verdict
@@ -0,0 +1,77 @@
+import json, os, subprocess, threading
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class MediaInfo(NamedTuple):
+    """Everything the pipeline needs to know about a target, probed once."""
+    fps: float
+    frame_total: int
+    duration: float
+    width: int
+    height: int
+    video_codec: str
+    pixel_format: str
+    has_audio: bool
+    keyframe_indices: List[int]
+    keyframe_times: List[float]
+
+
+PROBE_CACHE: Dict[Tuple[str, float, int], MediaInfo] = {}
+PROBE_LOCK = threading.Lock()
+
+
+def parse_rate(rate: str) -> float:
+    numerator, _, denominator = rate.partition('/')
+    return int(numerator) / int(denominator or 1) if numerator and denominator != '0' else 0.0
+
+
+def scan_packets(target_path: str) -> List[Tuple[float, bool]]:
+    """Lists the presentation time and keyframe flag of every video packet in display order."""
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', target_path]).decode()
+    packets = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if pts_time and pts_time != 'N/A':
+            packets.append((float(pts_time), 'K' in flags))
+    packets.sort()
+    return packets
+
+
+def probe_media(target_path: str) -> MediaInfo:
+    """Runs ffprobe on the streams and the video packets of the target."""
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name,pix_fmt,width,height,r_frame_rate,nb_frames:format=duration', '-of', 'json', target_path]).decode()
+    streams = json.loads(output).get('streams', [])
+    video_streams = [stream for stream in streams if stream.get('codec_type') == 'video']
+    if not video_streams:
+        raise ValueError(f'No video stream in {target_path}')
+    video_stream = video_streams[0]
+    packets = scan_packets(target_path)
+    start_time = packets[0][0] if packets else 0.0
+    keyframe_indices = [index for index, (_, is_keyframe) in enumerate(packets) if is_keyframe]
+    frame_total = len(packets) or int(video_stream.get('nb_frames') or 0)
+    try:
+        duration = float(json.loads(output)['format']['duration'])
+    except (KeyError, ValueError):
+        duration = 0.0
+    return MediaInfo(
+        fps=parse_rate(video_stream.get('r_frame_rate', '')) or 30.0,
+        frame_total=frame_total,
+        duration=duration,
+        width=int(video_stream.get('width', 0)),
+        height=int(video_stream.get('height', 0)),
+        video_codec=video_stream.get('codec_name', ''),
+        pixel_format=video_stream.get('pix_fmt', ''),
+        has_audio=any(stream.get('codec_type') == 'audio' for stream in streams),
+        keyframe_indices=keyframe_indices,
+        keyframe_times=[packets[index][0] - start_time for index in keyframe_indices]
+    )
+
+
+def probe(target_path: str) -> MediaInfo:
+    """Returns the media info of the target, probed again only when the file changes."""
+    stat = os.stat(target_path)
+    key = (os.path.abspath(target_path), stat.st_mtime, stat.st_size)
+    with PROBE_LOCK:
+        if key not in PROBE_CACHE:
+            PROBE_CACHE[key] = probe_media(target_path)
+        return PROBE_CACHE[key]
@@ -1,8 +1,13 @@
-import sys, importlib, modules, modules.globals
+import sys, importlib, cv2, modules, modules.globals
 from concurrent.futures import ThreadPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Dict, List, Callable, Optional
 from tqdm import tqdm
+from modules.events import watch_progress
+from modules.face_analyser import get_one_face, get_many_faces
+from modules.frame_store import read_frame, write_frame
+from modules.memory import GOVERNOR
+from modules.typing import Face, Frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -12,6 +17,20 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_image',
     'process_video'
 ]
+# Second generation interface, process_batch(source_face, items) updates the 'frame' of every item in place
+FRAME_PROCESSORS_INTERFACE_V2 = [
+    'PROCESSOR_INPUTS',
+    'PROCESSOR_OUTPUTS',
+    'process_batch'
+]
+# Inputs a processor declares, the source face and the faces detected in each frame
+SOURCE_FACE = 'source_face'
+DETECTIONS = 'detections'
+# Outputs a processor declares, changes inside the face regions keep the detections valid, changes to the whole frame do not
+ROI = 'roi'
+FRAME = 'frame'
+# Frames read, processed and written together by one worker
+FRAME_BATCH_SIZE = 4
 
 def load_frame_processor_module(frame_processor: str) -> Any:
     try:
@@ -31,6 +50,11 @@ def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType
     set_frame_processors_modules_from_ui(frame_processors)
     return FRAME_PROCESSORS_MODULES
 
+def clear_frame_processors_modules() -> None:
+    """Forgets the loaded processors, so the next lookup loads the ones configured by then."""
+    global FRAME_PROCESSORS_MODULES
+    FRAME_PROCESSORS_MODULES = []
+
 def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
     global FRAME_PROCESSORS_MODULES
     for frame_processor, state in modules.globals.fp_ui.items():
@@ -46,9 +70,61 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
             except Exception:
                 pass  # Optionally handle specific exceptions
 
-def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = [executor.submit(process_frames, source_path, [path], progress) for path in temp_frame_paths]
+class ProcessorAdapter:
+    """Runs a first generation processor through the second generation interface, one frame at a time."""
+    PROCESSOR_INPUTS = [SOURCE_FACE]
+    PROCESSOR_OUTPUTS = [FRAME]
+
+    def __init__(self, module: ModuleType) -> None:
+        self.module = module
+        self.NAME = module.NAME
+
+    def process_batch(self, source_face: Face, items: List[Dict[str, Any]]) -> None:
+        for item in items:
+            item['frame'] = self.module.process_frame(source_face, item['frame'])
+
+def get_processor_stage(module: ModuleType) -> Any:
+    return module if all(hasattr(module, name) for name in FRAME_PROCESSORS_INTERFACE_V2) else ProcessorAdapter(module)
+
+def detect_faces(frame: Frame) -> List[Face]:
+    return get_many_faces(frame) if modules.globals.many_faces else [face for face in [get_one_face(frame)] if face]
+
+class FramePipeline:
+    """Runs the frame processors fused over batches of frames, detecting faces once for every stage that can share them."""
+
+    def __init__(self, frame_processors: List[ModuleType], source_face: Face) -> None:
+        self.stages = [get_processor_stage(frame_processor) for frame_processor in frame_processors]
+        self.source_face = source_face
+
+    def init_worker(self) -> None:
+        """Prepares the per-worker state of every stage, called once in each worker before its first batch."""
+        for stage in self.stages:
+            if hasattr(stage, 'init_worker'):
+                stage.init_worker()
+
+    def process(self, frames: List[Frame]) -> List[Frame]:
+        items: List[Dict[str, Any]] = [{'frame': frame, 'faces': None} for frame in frames]
+        for stage in self.stages:
+            if DETECTIONS in stage.PROCESSOR_INPUTS:
+                for item in items:
+                    if item['faces'] is None:
+                        item['faces'] = detect_faces(item['frame'])
+            stage.process_batch(self.source_face, items)
+            if FRAME in stage.PROCESSOR_OUTPUTS:
+                for item in items:
+                    item['faces'] = None
+        return [item['frame'] for item in items]
+
+def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None, batch_size: int = 1, initializer: Callable[[], None] = None) -> None:
+    futures = []
+    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads, initializer=initializer) as executor:
+        # frames are submitted as the memory governor lets them in, instead of all at once, a batch counts with all its frames
+        for index in range(0, len(temp_frame_paths), batch_size):
+            batch_paths = temp_frame_paths[index:index + batch_size]
+            GOVERNOR.enter(len(batch_paths))
+            future = executor.submit(process_frames, source_path, batch_paths, progress)
+            future.add_done_callback(lambda _, frame_total=len(batch_paths): GOVERNOR.leave(frame_total))
+            futures.append(future)
         for future in futures:
             future.result()
 
@@ -57,4 +133,31 @@ def process_video(source_path: str, frame_paths: List[str], process_frames: Call
         progress.set_postfix({'execution_providers': modules.globals.execution_providers, 
                               'execution_threads': modules.globals.execution_threads, 
                               'max_memory': modules.globals.max_memory})
+        watch_progress(progress)
         multi_process_frame(source_path, frame_paths, process_frames, progress)
+
+def process_video_fused(source_path: str, frame_paths: List[str], frame_processors: List[ModuleType]) -> None:
+    """Runs all frame processors in one pass, each worker reading, processing and writing a batch of frames at a time."""
+    pipeline = FramePipeline(frame_processors, get_one_face(cv2.imread(source_path)))
+
+    def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
+        temp_frames: List[Optional[Frame]]
+        try:
+            temp_frames = pipeline.process([read_frame(temp_frame_path) for temp_frame_path in temp_frame_paths])
+        except Exception:
+            # nothing of the batch is written yet, its frames are retried one by one so only the failing ones stay unprocessed
+            temp_frames = [None] * len(temp_frame_paths)
+        for temp_frame_path, temp_frame in zip(temp_frame_paths, temp_frames):
+            try:
+                write_frame(temp_frame_path, temp_frame if temp_frame is not None else pipeline.process([read_frame(temp_frame_path)])[0])
+            except Exception as exception:
+                print(f'{temp_frame_path}: {exception}')
+        if progress:
+            progress.update(len(temp_frame_paths))
+
+    with tqdm(total=len(frame_paths), desc='Processing', unit='frame', dynamic_ncols=True) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers,
+                              'execution_threads': modules.globals.execution_threads,
+                              'max_memory': modules.globals.max_memory})
+        watch_progress(progress)
+        multi_process_frame(source_path, frame_paths, process_frames, progress, FRAME_BATCH_SIZE, pipeline.init_worker)
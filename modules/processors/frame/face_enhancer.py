@@ -1,23 +1,27 @@
-from typing import Any, List
-import cv2, threading, gfpgan, os, modules.globals, modules.processors.frame.core
+from typing import Any, Dict, List
+import cv2, threading, gfpgan, modules.globals, modules.processors.frame.core
 from modules.core import update_status
 from modules.face_analyser import get_one_face
+from modules.model_registry import get_model_url
+from modules.frame_store import read_frame, write_frame
 from modules.typing import Frame, Face
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video, is_image_directory
 
 FACE_ENHANCER = None
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-ENHANCER'
+# Second generation interface, the enhancer only runs on frames with a face and pastes back into the face regions
+PROCESSOR_INPUTS = [modules.processors.frame.core.DETECTIONS]
+PROCESSOR_OUTPUTS = [modules.processors.frame.core.ROI]
 
 def pre_check() -> bool:
-    download_directory_path = resolve_relative_path('..\models')
-    conditional_download(download_directory_path, ['https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth'])
-    return True
+    download_directory_path = resolve_relative_path('../models')
+    return conditional_download(download_directory_path, [get_model_url('GFPGANv1.4.pth')])
 
 def pre_start() -> bool:
-    if not (is_image(modules.globals.target_path) or is_video(modules.globals.target_path)):
-        update_status('Select an image or video for target path.', NAME)
+    if not (is_image(modules.globals.target_path) or is_video(modules.globals.target_path) or is_image_directory(modules.globals.target_path)):
+        update_status('Select an image, video or directory of images for target path.', NAME)
         return False
     return True
 
@@ -25,7 +29,7 @@ def get_face_enhancer() -> Any:
     global FACE_ENHANCER
     with THREAD_LOCK:
         if FACE_ENHANCER is None:
-            model_path = resolve_relative_path(f"..{'\\' if os.name == 'nt' else '/'}models/GFPGANv1.4.pth")
+            model_path = resolve_relative_path('../models/GFPGANv1.4.pth')
             FACE_ENHANCER = gfpgan.GFPGANer(model_path=model_path, upscale=1)  # type: ignore[attr-defined]
     return FACE_ENHANCER
 
@@ -39,11 +43,19 @@ def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
         temp_frame = enhance_face(temp_frame)
     return temp_frame
 
+def init_worker() -> None:
+    get_face_enhancer()
+
+def process_batch(source_face: Face, items: List[Dict[str, Any]]) -> None:
+    for item in items:
+        if item['faces']:
+            item['frame'] = enhance_face(item['frame'])
+
 def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
     for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
+        temp_frame = read_frame(temp_frame_path)
         result = process_frame(None, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
+        write_frame(temp_frame_path, result)
         if progress:
             progress.update(1)
 
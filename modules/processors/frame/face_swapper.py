@@ -1,29 +1,37 @@
-import cv2, insightface, threading, modules.globals, modules.processors.frame.core
-from typing import Any, List
+import cv2, threading, numpy as np, modules.globals, modules.processors.frame.core
+from insightface.utils import face_align
+from typing import Any, Dict, List, Tuple
 from modules.core import update_status
-from modules.face_analyser import get_one_face, get_many_faces, default_source_face
+from modules.face_analyser import get_one_face, get_first_face, get_many_faces, default_source_face
+from modules.frame_store import read_frame, write_frame
 from modules.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
-from modules.cluster_analysis import find_closest_centroid
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video, is_image_directory
+from modules.face_tracker import get_tracked_faces
+from modules.sessions import load_model
+from modules.model_registry import get_model_url
 
 FACE_SWAPPER = None
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-SWAPPER'
+# Second generation interface, the swapper works on shared detections and only changes the face regions
+PROCESSOR_INPUTS = [modules.processors.frame.core.SOURCE_FACE, modules.processors.frame.core.DETECTIONS]
+PROCESSOR_OUTPUTS = [modules.processors.frame.core.ROI]
+# Extra pixels around the pasted face so erosion and blur see the same zero border as on the full frame
+PASTE_MARGIN = 4
 
 def pre_check() -> bool:
     download_directory_path = resolve_relative_path('../models')
-    conditional_download(download_directory_path, ['https://huggingface.co/hacksider/deep-live-cam/blob/main/inswapper_128_fp16.onnx'])
-    return True
+    return conditional_download(download_directory_path, [get_model_url('inswapper_128_fp16.onnx')])
 
 def pre_start() -> bool:
     source_path_valid = is_image(modules.globals.source_path) and (modules.globals.map_faces or get_one_face(cv2.imread(modules.globals.source_path)))
-    target_path_valid = is_image(modules.globals.target_path) or is_video(modules.globals.target_path)
+    target_path_valid = is_image(modules.globals.target_path) or is_video(modules.globals.target_path) or is_image_directory(modules.globals.target_path)
     
     if not source_path_valid:
         update_status('Select an image for source path or no face detected.', NAME)
         return False
     if not target_path_valid:
-        update_status('Select an image or video for target path.', NAME)
+        update_status('Select an image, video or directory of images for target path.', NAME)
         return False
     return True
 
@@ -31,48 +39,134 @@ def get_face_swapper() -> Any:
     global FACE_SWAPPER
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128_fp16.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
+            FACE_SWAPPER = load_model(resolve_relative_path('../models/inswapper_128_fp16.onnx'))
     return FACE_SWAPPER
 
+def get_paste_region(matrix: Any, temp_frame: Frame, size: int) -> Tuple[int, int, int, int]:
+    inverse_matrix = cv2.invertAffineTransform(matrix)
+    corners = np.array([[0, 0], [size, 0], [0, size], [size, size]], dtype=np.float32) @ inverse_matrix[:, :2].T + inverse_matrix[:, 2]
+    height, width = temp_frame.shape[:2]
+    x_min, y_min = np.maximum(np.floor(corners.min(axis=0)).astype(int) - PASTE_MARGIN, 0)
+    x_max, y_max = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + PASTE_MARGIN, [width, height])
+    return x_min, y_min, x_max, y_max
+
+def paste_back(temp_roi: Frame, swapped_face: Frame, matrix: Any) -> None:
+    # same mask as insightface's paste back, but warped and blended inside the face region only
+    inverse_matrix = cv2.invertAffineTransform(matrix)
+    roi_size = (temp_roi.shape[1], temp_roi.shape[0])
+    img_mask = cv2.warpAffine(np.full(swapped_face.shape[:2], 255, dtype=np.float32), inverse_matrix, roi_size, borderValue=0.0)
+    swapped_face = cv2.warpAffine(swapped_face, inverse_matrix, roi_size, borderValue=0.0)
+    img_mask[img_mask > 20] = 255
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    if not len(mask_h_inds):
+        return
+    mask_size = int(np.sqrt((mask_h_inds.max() - mask_h_inds.min()) * (mask_w_inds.max() - mask_w_inds.min())))
+    k = max(mask_size // 10, 10)
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+    img_mask *= 1 / 255
+    # blend as roi + mask * (face - roi) in one float buffer instead of a temporary per operation
+    blended = swapped_face.astype(np.float32)
+    blended -= temp_roi
+    blended *= img_mask[:, :, np.newaxis]
+    blended += temp_roi
+    temp_roi[:] = blended
+
+def get_latent(face_swapper: Any, source_face: Face) -> Any:
+    latent = np.dot(source_face.normed_embedding.reshape((1, -1)), face_swapper.emap)
+    return latent / np.linalg.norm(latent)
+
+def run_face_swapper(face_swapper: Any, aligned_faces: List[Frame], latents: Any) -> Any:
+    # color correction feeds the model the other channel order, so the swap and the flip back are skipped
+    blob = cv2.dnn.blobFromImages(aligned_faces, 1.0 / face_swapper.input_std, face_swapper.input_size, (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=not modules.globals.color_correction)
+    # models exported with a fixed batch dimension are run in chunks of that size
+    batch_size = face_swapper.input_shape[0] if isinstance(face_swapper.input_shape[0], int) else len(aligned_faces)
+    predictions = [face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob[index:index + batch_size], face_swapper.input_names[1]: latents[index:index + batch_size]})[0] for index in range(0, len(aligned_faces), batch_size)]
+    swapped_faces = np.concatenate(predictions)
+    swapped_faces *= 255
+    swapped_faces = np.clip(swapped_faces, 0, 255, out=swapped_faces).transpose((0, 2, 3, 1)).astype(np.uint8)
+    return swapped_faces if modules.globals.color_correction else swapped_faces[:, :, :, ::-1]
+
+def swap_batch(frame_face_pairs: List[Tuple[List[Tuple[Face, Face]], Frame]]) -> List[Frame]:
+    """Swaps the face pairs of every frame with one batched model call for all of them."""
+    face_swapper = get_face_swapper()
+    size = face_swapper.input_size[0]
+    temp_frames, regions, aligned_faces, matrices, latents = [], [], [], [], []
+    # align every face against the untouched frame, so one batched model call covers them all
+    for face_pairs, temp_frame in frame_face_pairs:
+        for source_face, target_face in face_pairs:
+            aligned_face, matrix = face_align.norm_crop2(temp_frame, target_face.kps, size)
+            x_min, y_min, x_max, y_max = get_paste_region(matrix, temp_frame, size)
+            if x_max <= x_min or y_max <= y_min:
+                continue
+            temp_frames.append(temp_frame)
+            regions.append((x_min, y_min, x_max, y_max))
+            aligned_faces.append(aligned_face)
+            matrices.append(matrix)
+            latents.append(get_latent(face_swapper, source_face))
+    if aligned_faces:
+        swapped_faces = run_face_swapper(face_swapper, aligned_faces, np.concatenate(latents))
+        for temp_frame, (x_min, y_min, x_max, y_max), swapped_face, matrix in zip(temp_frames, regions, swapped_faces, matrices):
+            roi_matrix = matrix.copy()
+            roi_matrix[:, 2] += matrix[:, :2] @ [x_min, y_min]
+            paste_back(temp_frame[y_min:y_max, x_min:x_max], swapped_face, roi_matrix)
+    return [temp_frame for _, temp_frame in frame_face_pairs]
+
+def swap_faces(face_pairs: List[Tuple[Face, Face]], temp_frame: Frame) -> Frame:
+    return swap_batch([(face_pairs, temp_frame)])[0]
+
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    return swap_faces([(source_face, target_face)], temp_frame)
 
 def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    if modules.globals.color_correction:
-        temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-
     target_faces = get_many_faces(temp_frame) if modules.globals.many_faces else [get_one_face(temp_frame)]
-    
-    for target_face in target_faces:
-        if target_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
-    return temp_frame
+    return swap_faces([(source_face, target_face) for target_face in target_faces if target_face], temp_frame)
+
+def init_worker() -> None:
+    get_face_swapper()
+
+def process_batch(source_face: Face, items: List[Dict[str, Any]]) -> None:
+    """Swaps the source face into the detected faces of every item with one model call."""
+    frame_face_pairs = []
+    for item in items:
+        target_faces = item['faces'] if modules.globals.many_faces else [get_first_face(item['faces'])] if item['faces'] else []
+        frame_face_pairs.append(([(source_face, target_face) for target_face in target_faces], item['frame']))
+    for item, temp_frame in zip(items, swap_batch(frame_face_pairs)):
+        item['frame'] = temp_frame
+
+def get_live_face_pairs(temp_frame: Frame, default_face: Face = None) -> List[Tuple[Face, Face]]:
+    """Pairs every face in the live frame with the source of the mapped target it is tracked as."""
+    source_faces = modules.globals.simple_map.get('source_faces', [])
+    return [(default_face or source_faces[identity], face) for face, identity in get_tracked_faces(temp_frame)]
 
 def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
-    source_face = default_source_face() if modules.globals.many_faces else None
+    default_face = default_source_face() if modules.globals.many_faces else None
+    face_pairs = []
+
+    if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
+        return swap_faces(get_live_face_pairs(temp_frame, default_face), temp_frame)
 
     for map in modules.globals.souce_target_map:
-        target_faces = [f for f in map['target_faces_in_frame'] if f['location'] == temp_frame_path] if is_video(modules.globals.target_path) else [map['target']['face']]
-        
-        if source_face is None and "source" in map:
-            source_face = map['source']['face']
-        
-        for target_face in target_faces:
-            if target_face['faces']:
-                for face in target_face['faces']:
-                    temp_frame = swap_face(source_face, face, temp_frame)
-
-    return temp_frame
+        source_face = default_face or map.get('source', {}).get('face')
+        if source_face is None:
+            continue
+        if is_video(modules.globals.target_path):
+            target_faces = [face for frame in map['target_faces_in_frame'] if frame['location'] == temp_frame_path for face in frame['faces']]
+        else:
+            target_faces = [map['target']['face']] if 'target' in map else []
+        face_pairs.extend((source_face, target_face) for target_face in target_faces)
+
+    return swap_faces(face_pairs, temp_frame)
 
 def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
     source_face = get_one_face(cv2.imread(source_path)) if not modules.globals.map_faces else None
     
     for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
+        temp_frame = read_frame(temp_frame_path)
         try:
-            result = process_frame(source_face or process_frame_v2(temp_frame, temp_frame_path), temp_frame)
-            cv2.imwrite(temp_frame_path, result)
+            result = process_frame(source_face, temp_frame) if source_face else process_frame_v2(temp_frame, temp_frame_path)
+            write_frame(temp_frame_path, result)
         except Exception as exception:
             print(exception)
         if progress:
@@ -0,0 +1,181 @@
+import argparse, glob, os, sys, cv2, insightface, numpy as np, onnx, modules.globals
+from insightface.utils import face_align
+from onnx import numpy_helper
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from typing import Any, Dict, Iterator, List, Optional
+from modules.sessions import QUANTIZED_DIRECTORY, get_quantized_path
+from modules.utilities import resolve_relative_path
+
+QUANTIZE_MODES = ['dynamic', 'static']
+# Models worth quantizing for CPU deployments, the landmark and attribute models of buffalo_l are left alone
+SWAPPER_MODEL = resolve_relative_path('../models/inswapper_128_fp16.onnx')
+ANALYSER_MODELS = ['det_10g.onnx', 'w600k_r50.onnx']
+CALIBRATION_FRAME_LIMIT = 64
+
+
+def get_analyser_model_paths() -> List[str]:
+    model_directory = insightface.app.FaceAnalysis(name='buffalo_l', allowed_modules=['detection'], providers=['CPUExecutionProvider']).model_dir
+    return [os.path.join(model_directory, model_file) for model_file in ANALYSER_MODELS]
+
+
+def convert_float16_to_float(model: onnx.ModelProto) -> onnx.ModelProto:
+    """Turns a float16 model into float32, which the onnxruntime quantizer expects."""
+    graph = model.graph
+    for initializer in graph.initializer:
+        if initializer.data_type == onnx.TensorProto.FLOAT16:
+            initializer.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(initializer).astype(np.float32), initializer.name))
+    for value in list(graph.input) + list(graph.output) + list(graph.value_info):
+        if value.type.tensor_type.elem_type == onnx.TensorProto.FLOAT16:
+            value.type.tensor_type.elem_type = onnx.TensorProto.FLOAT
+    for node in graph.node:
+        for attribute in node.attribute:
+            if node.op_type == 'Cast' and attribute.name == 'to' and attribute.i == onnx.TensorProto.FLOAT16:
+                attribute.i = onnx.TensorProto.FLOAT
+            if attribute.type == onnx.AttributeProto.TENSOR and attribute.t.data_type == onnx.TensorProto.FLOAT16:
+                attribute.t.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(attribute.t).astype(np.float32), attribute.t.name))
+    return model
+
+
+def restore_emap(model_path: str, quantized_path: str) -> None:
+    """Puts the embedding map of the swapper back as last initializer, where insightface reads it from."""
+    emap = numpy_helper.to_array(onnx.load(model_path).graph.initializer[-1]).astype(np.float32)
+    model = onnx.load(quantized_path)
+    for initializer in [initializer for initializer in model.graph.initializer if initializer.name == 'emap']:
+        model.graph.initializer.remove(initializer)
+    model.graph.initializer.append(numpy_helper.from_array(emap, 'emap'))
+    onnx.save(model, quantized_path)
+
+
+def load_frames(frame_paths: List[str]) -> List[Any]:
+    frames = [cv2.imread(frame_path) for frame_path in frame_paths[:CALIBRATION_FRAME_LIMIT]]
+    return [frame for frame in frames if frame is not None]
+
+
+def get_frame_paths(frame_directory: str) -> List[str]:
+    return sorted(frame_path for pattern in ('*.png', '*.jpg', '*.jpeg', '*.bmp') for frame_path in glob.glob(os.path.join(frame_directory, pattern)))
+
+
+def get_detector_blob(model: Any, frame: Any) -> Any:
+    # same letterboxing as RetinaFace.detect at the default 640x640 input
+    input_size = (640, 640)
+    height, width = frame.shape[:2]
+    scale = min(input_size[0] / width, input_size[1] / height)
+    resized_frame = cv2.resize(frame, (int(width * scale), int(height * scale)))
+    detector_frame = np.zeros((input_size[1], input_size[0], 3), dtype=np.uint8)
+    detector_frame[:resized_frame.shape[0], :resized_frame.shape[1]] = resized_frame
+    return cv2.dnn.blobFromImage(detector_frame, 1.0 / model.input_std, input_size, (model.input_mean,) * 3, swapRB=True)
+
+
+class FrameDataReader(CalibrationDataReader):
+    """Feeds the calibration frames to the static quantizer in the input layout of one model."""
+
+    def __init__(self, inputs: Iterator[Dict[str, Any]]) -> None:
+        self.inputs = inputs
+
+    def get_next(self) -> Optional[Dict[str, Any]]:
+        return next(self.inputs, None)
+
+
+def get_calibration_inputs(model_path: str, frames: List[Any]) -> Iterator[Dict[str, Any]]:
+    """Yields model inputs built from the faces the full precision analyser finds in the frames."""
+    from modules.face_analyser import get_face_analyser
+
+    model = insightface.model_zoo.get_model(model_path, providers=['CPUExecutionProvider'])
+    input_names = [model_input.name for model_input in model.session.get_inputs()]
+    face_analyser = get_face_analyser()
+    source_face = None
+    for frame in frames:
+        if model.taskname == 'detection':
+            yield {input_names[0]: get_detector_blob(model, frame)}
+            continue
+        for face in face_analyser.get(frame):
+            if model.taskname == 'recognition':
+                crop = face_align.norm_crop(frame, landmark=face.kps, image_size=model.input_size[0])
+                yield {input_names[0]: cv2.dnn.blobFromImage(crop, 1.0 / model.input_std, model.input_size, (model.input_mean,) * 3, swapRB=True)}
+            elif model.taskname == 'inswapper':
+                if source_face is None:
+                    source_face = face
+                crop, _ = face_align.norm_crop2(frame, face.kps, model.input_size[0])
+                latent = np.dot(source_face.normed_embedding.reshape((1, -1)), model.emap)
+                yield {input_names[0]: cv2.dnn.blobFromImage(crop, 1.0 / model.input_std, model.input_size, (model.input_mean,) * 3, swapRB=True),
+                       input_names[1]: (latent / np.linalg.norm(latent)).astype(np.float32)}
+
+
+def quantize_model(model_path: str, mode: str = 'dynamic', frames: List[Any] = None) -> str:
+    """Writes the INT8 variant of the model, static quantization calibrates on the given frames."""
+    quantized_path = get_quantized_path(model_path)
+    os.makedirs(QUANTIZED_DIRECTORY, exist_ok=True)
+    float_path = f'{quantized_path}.float.onnx'
+    onnx.save(convert_float16_to_float(onnx.load(model_path)), float_path)
+    try:
+        if mode == 'static':
+            if not frames:
+                raise ValueError('Static quantization needs calibration frames')
+            quantize_static(float_path, quantized_path, FrameDataReader(get_calibration_inputs(model_path, frames)), quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+        else:
+            quantize_dynamic(float_path, quantized_path, weight_type=QuantType.QInt8)
+    finally:
+        os.remove(float_path)
+    if os.path.basename(model_path) == os.path.basename(SWAPPER_MODEL):
+        restore_emap(model_path, quantized_path)
+    return quantized_path
+
+
+def cosine_similarity(first: Any, second: Any) -> float:
+    return float(np.dot(first, second) / (np.linalg.norm(first) * np.linalg.norm(second)))
+
+
+def compare_models(model_path: str, frames: List[Any]) -> Dict[str, float]:
+    """Compares the quantized model against the full precision one on the faces found in the frames."""
+    from modules.face_analyser import get_face_analyser
+
+    full_model = insightface.model_zoo.get_model(model_path, providers=['CPUExecutionProvider'])
+    quantized_model = insightface.model_zoo.get_model(get_quantized_path(model_path), providers=['CPUExecutionProvider'])
+    if full_model.taskname == 'detection':
+        for model in (full_model, quantized_model):
+            model.prepare(0, input_size=(640, 640))
+        detections = [(full_model.detect(frame)[0], quantized_model.detect(frame)[0]) for frame in frames]
+        return {'faces': sum(len(full_boxes) for full_boxes, _ in detections),
+                'missed_faces': sum(max(len(full_boxes) - len(quantized_boxes), 0) for full_boxes, quantized_boxes in detections),
+                'extra_faces': sum(max(len(quantized_boxes) - len(full_boxes), 0) for full_boxes, quantized_boxes in detections)}
+    faces = [(frame, face) for frame in frames for face in get_face_analyser().get(frame)]
+    if not faces:
+        return {'faces': 0}
+    if full_model.taskname == 'recognition':
+        similarities = [cosine_similarity(full_model.get(frame, face), quantized_model.get(frame, face)) for frame, face in faces]
+        return {'faces': len(faces), 'mean_cosine': float(np.mean(similarities)), 'min_cosine': float(np.min(similarities))}
+    source_face = faces[0][1]
+    differences = []
+    for frame, face in faces:
+        full_face, _ = full_model.get(frame, face, source_face, paste_back=False)
+        quantized_face, _ = quantized_model.get(frame, face, source_face, paste_back=False)
+        differences.append(full_face.astype(np.float32) - quantized_face.astype(np.float32))
+    mse = float(np.mean([np.square(difference).mean() for difference in differences]))
+    return {'faces': len(faces), 'mean_abs_diff': float(np.mean([np.abs(difference).mean() for difference in differences])),
+            'psnr': float(20 * np.log10(255 / np.sqrt(max(mse, 1e-12))))}
+
+
+def get_model_paths() -> List[str]:
+    return [SWAPPER_MODEL] + get_analyser_model_paths()
+
+
+if __name__ == '__main__':
+    program = argparse.ArgumentParser(prog='python -m modules.quantize', description='create and check INT8 variants of the face swapper, detection and recognition models')
+    program.add_argument('command', help='quantize the models or compare them against full precision', choices=['quantize', 'compare'])
+    program.add_argument('--mode', help='dynamic quantizes weights only, static also calibrates activations on the frames', dest='mode', default='dynamic', choices=QUANTIZE_MODES)
+    program.add_argument('--frames', help='directory of frames to calibrate and compare on', dest='frame_directory')
+    args = program.parse_args()
+
+    modules.globals.execution_providers = ['CPUExecutionProvider']
+    frames = load_frames(get_frame_paths(args.frame_directory)) if args.frame_directory else []
+    if args.command == 'compare' and not frames:
+        print('Comparing needs a directory of frames with faces')
+        sys.exit(1)
+    for model_path in get_model_paths():
+        if not os.path.isfile(model_path):
+            print(f'{os.path.basename(model_path)}: missing, run the app once to download it')
+            continue
+        if args.command == 'quantize':
+            print(f'{os.path.basename(model_path)}: {quantize_model(model_path, args.mode, frames)}')
+        elif os.path.isfile(get_quantized_path(model_path)):
+            print(f'{os.path.basename(model_path)}: ' + ', '.join(f'{name} {value:.4f}' if isinstance(value, float) else f'{name} {value}' for name, value in compare_models(model_path, frames).items()))
@@ -0,0 +1,166 @@
+import os, shutil, cv2, modules.globals
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+from tqdm import tqdm
+from modules.events import watch_progress
+from modules.face_analyser import has_any_face
+from modules.frame_ring import process_video_stream
+from modules.probe import probe
+from modules.utilities import detect_keyframes, get_temp_directory_path, run_ffmpeg
+
+SEGMENT_DIRECTORY = 'segments'
+SEGMENT_RING_SIZE = 8
+# Codec each output encoder produces, packets of the target can only be joined with segments of the same codec.
+# Only h264 is listed: the concat demuxer converts it to Annex B, so the parameter sets of every segment stay in-band
+# and the decoder switches between those of the target and those of the encoder, other codecs keep only the first ones
+ENCODER_CODECS = {'libx264': 'h264'}
+
+
+def plan_segments(target_path: str, segment_total: int) -> List[Tuple[float, int, int]]:
+    """Split the video into keyframe aligned segments of start time, first frame and frame count."""
+    keyframe_indices, keyframe_times = detect_keyframes(target_path)
+    if not keyframe_times:
+        return []
+    frame_total = keyframe_indices[-1]
+    starts = []
+    next_split = 0
+    for keyframe_index, keyframe_time in zip(keyframe_indices, keyframe_times):
+        if keyframe_index >= next_split:
+            starts.append((keyframe_time, keyframe_index))
+            next_split = keyframe_index + frame_total / segment_total
+    segments = []
+    for index, (start_time, first_frame) in enumerate(starts):
+        next_frame = starts[index + 1][1] if index + 1 < len(starts) else frame_total
+        segments.append((start_time, first_frame, next_frame - first_frame))
+    return segments
+
+
+def get_segment_path(target_path: str, index: int) -> str:
+    return os.path.join(get_temp_directory_path(target_path), SEGMENT_DIRECTORY, f'{index:04d}.mp4')
+
+
+def process_segment(source_path: str, target_path: str, segment: Tuple[float, int, int], segment_path: str, fps: float, source_fps: float, worker_total: int, progress: Any, screen: Any = None, convert_colorspace: bool = True, repeat_headers: bool = False) -> bool:
+    """Decode, process and encode one segment, retrying it on failure."""
+    start_time, _, frame_total = segment
+    # seek just past the keyframe without accurate seeking, so decoding starts exactly on it
+    input_args = ['-noaccurate_seek', '-ss', f'{start_time + 0.25 / source_fps:.6f}']
+    for _ in range(modules.globals.segment_retries + 1):
+        # no point in retrying a segment of a target found to be NSFW
+        if screen is not None and screen.verdict:
+            return False
+        if process_video_stream(source_path, target_path, segment_path, fps, input_args, frame_total, modules.globals.frame_ring_size or SEGMENT_RING_SIZE, worker_total, progress, screen, convert_colorspace, repeat_headers) and os.path.isfile(segment_path):
+            return True
+    return False
+
+
+def concat_segments(segment_paths: List[str], output_path: str) -> bool:
+    """Join the encoded segments without re-encoding through the concat demuxer."""
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(list_path, 'w') as list_file:
+        for segment_path in segment_paths:
+            # quotes in the path close the quoted string, the concat demuxer takes an escaped one between two quoted parts
+            list_file.write("file '" + os.path.abspath(segment_path).replace("'", "'\\''") + "'\n")
+    return run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-y', output_path])
+
+
+def process_video_segments(source_path: str, target_path: str, output_path: str, fps: float, source_fps: float, screen: Any = None) -> bool:
+    """Process keyframe aligned segments of the target in parallel and join them into the output."""
+    segments = plan_segments(target_path, modules.globals.segment_jobs)
+    if not segments:
+        return False
+    segment_paths = [get_segment_path(target_path, index) for index in range(len(segments))]
+    os.makedirs(os.path.dirname(segment_paths[0]), exist_ok=True)
+    job_total = min(modules.globals.segment_jobs, len(segments))
+    worker_total = max(1, modules.globals.execution_threads // job_total)
+    with tqdm(total=sum(frame_total for _, _, frame_total in segments), desc='Processing', unit='frame', dynamic_ncols=True) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers,
+                              'execution_threads': modules.globals.execution_threads,
+                              'segments': len(segments)})
+        watch_progress(progress)
+        with ThreadPoolExecutor(max_workers=job_total) as executor:
+            futures = [executor.submit(process_segment, source_path, target_path, segment, segment_path, fps, source_fps, worker_total, progress, screen) for segment, segment_path in zip(segments, segment_paths)]
+            results = [future.result() for future in futures]
+    if not all(results):
+        return False
+    result = concat_segments(segment_paths, output_path)
+    shutil.rmtree(os.path.dirname(segment_paths[0]), ignore_errors=True)
+    return result
+
+
+def can_copy_segments(target_path: str, fps: float) -> bool:
+    """Checks whether packets of the target can be joined with segments the encoder produces."""
+    media_info = probe(target_path)
+    return ENCODER_CODECS.get(modules.globals.video_encoder) == media_info.video_codec and media_info.pixel_format == 'yuv420p' and abs(media_info.fps - fps) < 0.01
+
+
+def find_faceless_gops(target_path: str, screen: Any = None) -> List[bool]:
+    """Decodes the target once and tells for every GOP whether none of its frames has a face."""
+    keyframe_indices, _ = detect_keyframes(target_path)
+    capture = cv2.VideoCapture(target_path)
+    faceless = []
+    with tqdm(total=keyframe_indices[-1], desc='Finding faceless GOPs', unit='frame', dynamic_ncols=True) as progress:
+        watch_progress(progress)
+        for first_frame, next_frame in zip(keyframe_indices, keyframe_indices[1:]):
+            gop_faceless = True
+            for _ in range(next_frame - first_frame):
+                has_frame, frame = capture.read()
+                if not has_frame:
+                    break
+                if screen is not None:
+                    screen.feed(frame)
+                # the rest of a GOP with a face is re-encoded anyway, a missed face stays unswapped for the whole GOP,
+                # so this uses the detector of the full analyser and not the downscaled one of --skip-faceless
+                if gop_faceless and has_any_face(frame):
+                    gop_faceless = False
+                progress.update(1)
+            faceless.append(gop_faceless)
+    capture.release()
+    return faceless
+
+
+def plan_smart_segments(target_path: str, screen: Any = None) -> List[Tuple[float, int, int, bool]]:
+    """Split the video into runs of GOPs of start time, first frame, frame count and whether the run is copied."""
+    keyframe_indices, keyframe_times = detect_keyframes(target_path)
+    if not keyframe_times:
+        return []
+    segments: List[Tuple[float, int, int, bool]] = []
+    for start_time, first_frame, next_frame, faceless in zip(keyframe_times, keyframe_indices, keyframe_indices[1:], find_faceless_gops(target_path, screen)):
+        if segments and segments[-1][3] == faceless:
+            run_time, run_frame, run_total, _ = segments[-1]
+            segments[-1] = (run_time, run_frame, run_total + next_frame - first_frame, faceless)
+        else:
+            segments.append((start_time, first_frame, next_frame - first_frame, faceless))
+    return segments
+
+
+def copy_segment(target_path: str, segment: Tuple[float, int, int, bool], segment_path: str, source_fps: float) -> bool:
+    """Stream-copy the video packets of the segment from the target."""
+    start_time, _, frame_total, _ = segment
+    return run_ffmpeg(['-noaccurate_seek', '-ss', f'{start_time + 0.25 / source_fps:.6f}', '-i', target_path, '-frames:v', str(frame_total), '-map', '0:v:0', '-c', 'copy', '-an', '-avoid_negative_ts', 'make_zero', '-y', segment_path])
+
+
+def process_video_smart(source_path: str, target_path: str, output_path: str, fps: float, screen: Any = None) -> bool:
+    """Stream-copy the GOPs without faces, process the others and join them into the output."""
+    segments = plan_smart_segments(target_path, screen)
+    if not segments or (screen is not None and screen.finish()):
+        return False
+    segment_paths = [get_segment_path(target_path, index) for index in range(len(segments))]
+    os.makedirs(os.path.dirname(segment_paths[0]), exist_ok=True)
+    processed_segments = [segment for segment in segments if not segment[3]]
+    job_total = max(1, min(modules.globals.segment_jobs, len(processed_segments)))
+    worker_total = max(1, modules.globals.execution_threads // job_total)
+    with tqdm(total=sum(frame_total for _, _, frame_total, _ in processed_segments), desc='Processing', unit='frame', dynamic_ncols=True) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers,
+                              'execution_threads': modules.globals.execution_threads,
+                              'copied_frames': sum(frame_total for _, _, frame_total, faceless in segments if faceless)})
+        watch_progress(progress)
+        with ThreadPoolExecutor(max_workers=job_total) as executor:
+            # the copied GOPs keep the YUV values of the target, so the processed ones must not be converted to another colorspace,
+            # and they carry their own parameter sets in-band, as the profile and level of the target may differ
+            futures = [executor.submit(copy_segment, target_path, segment, segment_path, fps) if segment[3] else executor.submit(process_segment, source_path, target_path, segment[:3], segment_path, fps, fps, worker_total, progress, None, False, True) for segment, segment_path in zip(segments, segment_paths)]
+            results = [future.result() for future in futures]
+    if not all(results):
+        return False
+    result = concat_segments(segment_paths, output_path)
+    shutil.rmtree(os.path.dirname(segment_paths[0]), ignore_errors=True)
+    return result
@@ -0,0 +1,204 @@
+import glob, hashlib, json, os, platform, threading, time, numpy as np, onnxruntime, modules.globals
+from insightface.app import FaceAnalysis
+from insightface.model_zoo.model_zoo import PickableInferenceSession, ArcFaceONNX, RetinaFace, Landmark, Attribute, INSwapper
+from insightface.utils import ensure_available
+from typing import Any, Dict, List, Optional
+from modules.utilities import resolve_relative_path
+
+NAME = 'DLC.SESSIONS'
+OPTIMIZED_DIRECTORY = resolve_relative_path('../models/optimized')
+OPTIMIZED_INDEX = os.path.join(OPTIMIZED_DIRECTORY, 'index.json')
+# INT8 variants written by python -m modules.quantize
+QUANTIZED_DIRECTORY = resolve_relative_path('../models/int8')
+OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL
+}
+# Providers that compile nodes into their own kernels cannot save the optimized graph
+CACHEABLE_PROVIDERS = ['CPUExecutionProvider', 'CUDAExecutionProvider', 'ROCMExecutionProvider']
+# Largest difference between batched and single runs a copy with a dynamic batch dimension may show
+BATCHED_TOLERANCE = 1e-2
+ONNX_TYPES = {'tensor(float)': np.float32, 'tensor(float16)': np.float16}
+INDEX_LOCK = threading.Lock()
+
+
+def get_quantized_path(model_path: str) -> str:
+    return os.path.join(QUANTIZED_DIRECTORY, f'{os.path.splitext(os.path.basename(model_path))[0]}.int8.onnx')
+
+
+def get_model_path(model_path: str) -> str:
+    """Returns the quantized variant of the model when quantized models are enabled and it exists."""
+    if modules.globals.quantized_models and os.path.isfile(get_quantized_path(model_path)):
+        return get_quantized_path(model_path)
+    return model_path
+
+
+def load_index() -> Dict[str, Any]:
+    try:
+        with open(OPTIMIZED_INDEX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_index(key: str, value: Any) -> None:
+    with INDEX_LOCK:
+        index = load_index()
+        index[key] = value
+        os.makedirs(OPTIMIZED_DIRECTORY, exist_ok=True)
+        temp_path = f'{OPTIMIZED_INDEX}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(temp_path, OPTIMIZED_INDEX)
+
+
+def get_model_hash(model_path: str) -> str:
+    """Hashes the model, remembering the hash by path, modification time and size across launches."""
+    stat = os.stat(model_path)
+    key = f'hash:{os.path.abspath(model_path)}:{stat.st_mtime}:{stat.st_size}'
+    model_hash = load_index().get(key)
+    if model_hash is None:
+        digest = hashlib.sha256()
+        with open(model_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        model_hash = digest.hexdigest()
+        update_index(key, model_hash)
+    return model_hash
+
+
+def get_optimized_path(model_path: str, providers: List[str]) -> str:
+    """Returns where the optimized model is cached, keyed by model hash, providers, ORT version and optimization level."""
+    # the fully optimized graph may use kernels specific to this kind of machine
+    key = '|'.join([get_model_hash(model_path), ','.join(providers), onnxruntime.__version__, modules.globals.session_optimization, platform.machine()])
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(OPTIMIZED_DIRECTORY, f'{name}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.onnx')
+
+
+def get_session_options() -> onnxruntime.SessionOptions:
+    """Builds the session options from the global settings."""
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = OPTIMIZATION_LEVELS[modules.globals.session_optimization]
+    session_options.execution_mode = EXECUTION_MODES[modules.globals.session_execution_mode]
+    session_options.intra_op_num_threads = modules.globals.session_threads
+    session_options.enable_cpu_mem_arena = modules.globals.session_memory_arena
+    if modules.globals.session_thread_affinity:
+        session_options.add_session_config_entry('session.intra_op_thread_affinities', modules.globals.session_thread_affinity)
+    return session_options
+
+
+def is_cacheable(providers: List[str]) -> bool:
+    return modules.globals.optimized_cache and modules.globals.session_optimization != 'disable' and all(provider in CACHEABLE_PROVIDERS for provider in providers)
+
+
+def create_session(model_path: str, providers: List[str]) -> PickableInferenceSession:
+    """Creates the session, from the cached optimized model when there is one, and reports the build time."""
+    session_options = get_session_options()
+    session_path = model_path
+    cached = False
+    if is_cacheable(providers):
+        optimized_path = get_optimized_path(model_path, providers)
+        if os.path.isfile(optimized_path):
+            # the cached graph is optimized already
+            session_options.graph_optimization_level = OPTIMIZATION_LEVELS['disable']
+            session_path = optimized_path
+            cached = True
+        else:
+            os.makedirs(OPTIMIZED_DIRECTORY, exist_ok=True)
+            # written aside and renamed, so concurrent launches never load a partial model
+            session_options.optimized_model_filepath = f'{optimized_path}.{os.getpid()}.tmp'
+    start_time = time.perf_counter()
+    session = PickableInferenceSession(session_path, sess_options=session_options, providers=providers)
+    build_time = time.perf_counter() - start_time
+    name = os.path.basename(model_path)
+    if cached:
+        uncached_time = load_index().get(f'time:{os.path.basename(session_path)}')
+        saved = f', {uncached_time - build_time:.2f}s saved by the optimized model cache' if uncached_time else ''
+        print(f'[{NAME}] {name}: session built in {build_time:.2f}s{saved}')
+    else:
+        if session_options.optimized_model_filepath and os.path.isfile(session_options.optimized_model_filepath):
+            os.replace(session_options.optimized_model_filepath, optimized_path)
+            update_index(f'time:{os.path.basename(optimized_path)}', build_time)
+        print(f'[{NAME}] {name}: session built in {build_time:.2f}s')
+    return session
+
+
+def run_single(session: Any, feeds: Dict[str, np.ndarray]) -> np.ndarray:
+    return np.concatenate([session.run(None, {name: feed[index:index + 1] for name, feed in feeds.items()})[0] for index in range(len(next(iter(feeds.values()))))])
+
+
+def create_batched_model(model_path: str, session: Any) -> Optional[str]:
+    """Writes a copy of a model exported with a fixed batch size of one with a dynamic batch dimension instead.
+
+    The copy is only used when a batch of two gives the results of two single runs, the verdict is cached by model hash.
+    """
+    import onnx
+
+    key = f'batched:{get_model_hash(model_path)}'
+    batched_path = os.path.join(OPTIMIZED_DIRECTORY, f'{os.path.splitext(os.path.basename(model_path))[0]}.{get_model_hash(model_path)[:16]}.batched.onnx')
+    try:
+        model = onnx.load(model_path)
+        for value in list(model.graph.input) + list(model.graph.output):
+            value.type.tensor_type.shape.dim[0].dim_param = 'batch'
+        # shapes inferred for a batch of one would contradict the dynamic dimension
+        del model.graph.value_info[:]
+        os.makedirs(OPTIMIZED_DIRECTORY, exist_ok=True)
+        temp_path = f'{batched_path}.{os.getpid()}.tmp'
+        onnx.save(model, temp_path)
+        batched_session = onnxruntime.InferenceSession(temp_path, providers=session.get_providers())
+        feeds = {value.name: np.random.default_rng(0).random((2,) + tuple(value.shape[1:])).astype(ONNX_TYPES.get(value.type, np.float32)) for value in session.get_inputs()}
+        valid = np.allclose(batched_session.run(None, feeds)[0], run_single(session, feeds), atol=BATCHED_TOLERANCE)
+    except Exception as exception:
+        print(f'[{NAME}] {os.path.basename(model_path)}: keeping the fixed batch size, {type(exception).__name__}')
+        valid = False
+    if valid:
+        os.replace(temp_path, batched_path)
+    elif os.path.isfile(f'{batched_path}.{os.getpid()}.tmp'):
+        os.remove(f'{batched_path}.{os.getpid()}.tmp')
+    update_index(key, batched_path if valid else False)
+    return batched_path if valid else None
+
+
+def load_model(model_path: str, providers: List[str] = None) -> Any:
+    """Same routing as insightface's model zoo, on a session built with the configured options."""
+    model_path = get_model_path(model_path)
+    providers = providers or modules.globals.execution_providers
+    batched_path = load_index().get(f'batched:{get_model_hash(model_path)}')
+    session = create_session(batched_path if batched_path and os.path.isfile(batched_path) else model_path, providers)
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_path, session=session)
+    if input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_path, session=session)
+    if input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_path, session=session)
+    if len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        # the swapper is exported for a batch of one, a batched copy lets all faces of a frame batch go through one call
+        if isinstance(input_shape[0], int) and batched_path is None:
+            batched_path = create_batched_model(model_path, session)
+            if batched_path:
+                session = create_session(batched_path, providers)
+        return INSwapper(model_file=model_path, session=session)
+    if input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_path, session=session)
+    return None
+
+
+def create_face_analyser(name: str = 'buffalo_l', allowed_modules: List[str] = None) -> FaceAnalysis:
+    """Builds a FaceAnalysis like its constructor does, but with sessions from load_model."""
+    face_analyser = FaceAnalysis.__new__(FaceAnalysis)
+    face_analyser.models = {}
+    face_analyser.model_dir = ensure_available('models', name, root='~/.insightface')
+    for model_path in sorted(glob.glob(os.path.join(face_analyser.model_dir, '*.onnx'))):
+        model = load_model(model_path)
+        if model is not None and model.taskname not in face_analyser.models and (allowed_modules is None or model.taskname in allowed_modules):
+            face_analyser.models[model.taskname] = model
+    face_analyser.det_model = face_analyser.models['detection']
+    return face_analyser
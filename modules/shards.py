@@ -0,0 +1,196 @@
+import json, os, shutil, socket, threading, time, uuid, modules.globals
+from typing import Any, Dict, List
+from tqdm import tqdm
+from modules.events import watch_progress
+from modules.segmenter import plan_segments, process_segment, concat_segments
+from modules.utilities import detect_fps, mux_audio
+
+JOB_FILE = 'job.json'
+SHARD_DIRECTORY = 'shards'
+LOCK_DIRECTORY = 'locks'
+ASSEMBLED_FILE = 'assembled.mp4'
+# A lock without heartbeat for this long belongs to a dead worker and may be reclaimed
+SHARD_LOCK_TIMEOUT = 300
+SHARD_HEARTBEAT_INTERVAL = 30
+SHARD_POLL_INTERVAL = 2
+# Failed renders of one shard, across all workers, after which the job gives up on it
+MAX_SHARD_ATTEMPTS = 3
+
+# Settings every worker takes from the job so all shards are rendered alike
+JOB_SETTINGS = ['frame_processors', 'fp_ui', 'many_faces', 'color_correction', 'skip_faceless', 'duplicate_threshold', 'keep_fps', 'keep_audio', 'video_encoder', 'video_quality', 'quantized_models']
+
+
+def get_job_path(shard_dir: str) -> str:
+    return os.path.join(shard_dir, JOB_FILE)
+
+
+def get_shard_path(shard_dir: str, index: int) -> str:
+    return os.path.join(shard_dir, SHARD_DIRECTORY, f'{index:04d}.mp4')
+
+
+def get_lock_path(shard_dir: str, index: int) -> str:
+    return os.path.join(shard_dir, LOCK_DIRECTORY, f'{index:04d}.lock')
+
+
+def get_failure_path(shard_dir: str, index: int) -> str:
+    return os.path.join(shard_dir, LOCK_DIRECTORY, f'{index:04d}.failed')
+
+
+def get_failure_count(shard_dir: str, index: int) -> int:
+    try:
+        with open(get_failure_path(shard_dir, index)) as file:
+            return len(file.readlines())
+    except OSError:
+        return 0
+
+
+def record_failure(shard_dir: str, index: int) -> None:
+    """Appends a line per failed render, appends of concurrent workers do not overwrite each other."""
+    with open(get_failure_path(shard_dir, index), 'a') as file:
+        file.write(f'{socket.gethostname()} {os.getpid()}\n')
+
+
+def write_json(path: str, data: Dict[str, Any]) -> None:
+    """Write the json file atomically, readers never see a partial file."""
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def create_job(shard_dir: str, source_path: str, target_path: str, output_path: str, shard_total: int) -> Dict[str, Any]:
+    """Split the target into keyframe aligned frame-range shards and publish the job."""
+    for directory in (SHARD_DIRECTORY, LOCK_DIRECTORY):
+        shutil.rmtree(os.path.join(shard_dir, directory), ignore_errors=True)
+    os.makedirs(os.path.join(shard_dir, SHARD_DIRECTORY), exist_ok=True)
+    os.makedirs(os.path.join(shard_dir, LOCK_DIRECTORY), exist_ok=True)
+    source_fps = detect_fps(target_path)
+    job = {
+        'source_path': os.path.abspath(source_path),
+        'target_path': os.path.abspath(target_path),
+        'output_path': os.path.abspath(output_path),
+        'source_fps': source_fps,
+        'fps': source_fps if modules.globals.keep_fps else 30.0,
+        'settings': {name: getattr(modules.globals, name) for name in JOB_SETTINGS},
+        'shards': [{'start_time': start_time, 'first_frame': first_frame, 'frame_total': frame_total} for start_time, first_frame, frame_total in plan_segments(target_path, shard_total)]
+    }
+    write_json(get_job_path(shard_dir), job)
+    return job
+
+
+def load_job(shard_dir: str) -> Dict[str, Any]:
+    """Wait for the job to be published, load it and apply its settings to this worker."""
+    while not os.path.isfile(get_job_path(shard_dir)):
+        time.sleep(SHARD_POLL_INTERVAL)
+    with open(get_job_path(shard_dir)) as file:
+        job = json.load(file)
+    for name, value in job['settings'].items():
+        setattr(modules.globals, name, value)
+    modules.globals.source_path = job['source_path']
+    modules.globals.target_path = job['target_path']
+    modules.globals.output_path = job['output_path']
+    return job
+
+
+def claim_shard(shard_dir: str, index: int) -> bool:
+    """Claim the shard through an exclusively created lock file, reclaiming stale locks."""
+    lock_path = get_lock_path(shard_dir, index)
+    if os.path.isfile(get_shard_path(shard_dir, index)) or get_failure_count(shard_dir, index) >= MAX_SHARD_ATTEMPTS:
+        return False
+    try:
+        if time.time() - os.path.getmtime(lock_path) > SHARD_LOCK_TIMEOUT:
+            # only one worker wins the rename, the age is checked again on the renamed file because
+            # another worker may have replaced the stale lock with a fresh one in the meantime
+            stale_path = f'{lock_path}.{uuid.uuid4().hex}.stale'
+            os.rename(lock_path, stale_path)
+            if time.time() - os.path.getmtime(stale_path) <= SHARD_LOCK_TIMEOUT:
+                # put the live lock back, unless yet another worker has created one meanwhile
+                try:
+                    os.link(stale_path, lock_path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+    except OSError:
+        pass
+    try:
+        lock_file = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(lock_file, 'w') as file:
+        file.write(f'{socket.gethostname()} {os.getpid()}\n')
+    return True
+
+
+def keep_alive(lock_path: str, stop_event: threading.Event) -> None:
+    while not stop_event.wait(SHARD_HEARTBEAT_INTERVAL):
+        try:
+            os.utime(lock_path)
+        except OSError:
+            # a hiccup of the shared filesystem, stopping would let the lock go stale while the shard still renders
+            pass
+
+
+def process_shard(shard_dir: str, job: Dict[str, Any], index: int, progress: Any) -> bool:
+    """Render the shard to a part file and publish it with an atomic rename."""
+    shard = job['shards'][index]
+    shard_path = get_shard_path(shard_dir, index)
+    part_path = f'{os.path.splitext(shard_path)[0]}.{uuid.uuid4().hex[:8]}.part.mp4'
+    lock_path = get_lock_path(shard_dir, index)
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=keep_alive, args=(lock_path, stop_event), daemon=True)
+    heartbeat.start()
+    try:
+        if process_segment(job['source_path'], job['target_path'], (shard['start_time'], shard['first_frame'], shard['frame_total']), part_path, job['fps'], job['source_fps'], modules.globals.execution_threads, progress):
+            os.replace(part_path, shard_path)
+            return True
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        record_failure(shard_dir, index)
+        os.remove(lock_path)
+        return False
+    finally:
+        stop_event.set()
+        heartbeat.join()
+
+
+def get_pending_shards(shard_dir: str, job: Dict[str, Any]) -> List[int]:
+    return [index for index in range(len(job['shards'])) if not os.path.isfile(get_shard_path(shard_dir, index))]
+
+
+def run_worker(shard_dir: str, job: Dict[str, Any]) -> int:
+    """Claim and render shards until none is left to claim, returns the number rendered."""
+    rendered = 0
+    with tqdm(desc='Processing shards', unit='frame', dynamic_ncols=True) as progress:
+        progress.set_postfix({'host': socket.gethostname(), 'execution_threads': modules.globals.execution_threads})
+        watch_progress(progress)
+        for index in get_pending_shards(shard_dir, job):
+            if claim_shard(shard_dir, index) and process_shard(shard_dir, job, index, progress):
+                rendered += 1
+    return rendered
+
+
+def get_failed_shards(shard_dir: str, job: Dict[str, Any]) -> List[int]:
+    return [index for index in get_pending_shards(shard_dir, job) if get_failure_count(shard_dir, index) >= MAX_SHARD_ATTEMPTS]
+
+
+def wait_for_shards(shard_dir: str, job: Dict[str, Any]) -> bool:
+    """Wait for the other workers, taking over shards whose worker died, False once a shard failed too often."""
+    while get_pending_shards(shard_dir, job):
+        if get_failed_shards(shard_dir, job):
+            return False
+        run_worker(shard_dir, job)
+        time.sleep(SHARD_POLL_INTERVAL)
+    return True
+
+
+def assemble_job(shard_dir: str, job: Dict[str, Any]) -> bool:
+    """Join the rendered shards and mux the audio of the target into the output."""
+    if get_pending_shards(shard_dir, job):
+        return False
+    assembled_path = os.path.join(shard_dir, ASSEMBLED_FILE)
+    if not concat_segments([get_shard_path(shard_dir, index) for index in range(len(job['shards']))], assembled_path):
+        return False
+    if not (job['settings']['keep_audio'] and mux_audio(assembled_path, job['target_path'], job['output_path'])):
+        shutil.move(assembled_path, job['output_path'])
+    return True
@@ -0,0 +1,168 @@
+import subprocess, threading, cv2, numpy as np, modules.globals
+from multiprocessing import shared_memory
+from typing import Any, List, Optional, Tuple
+from modules.buffer_pool import BUFFER_POOL
+from modules.typing import Frame
+from modules.utilities import open_ffmpeg
+
+NAME = 'DLC.SINKS'
+# Header of the shared memory frame: sequence, height, width and channels as unsigned 64 bit integers
+SHARED_HEADER_SIZE = 32
+# Container formats ffmpeg cannot guess from a streaming url
+STREAM_FORMATS = {'rtmp://': 'flv', 'rtmps://': 'flv', 'udp://': 'mpegts', 'srt://': 'mpegts', 'tcp://': 'mpegts'}
+
+
+class SharedMemorySink:
+    """Publishes the latest frame in a named shared memory block that local processes can map."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.memory: shared_memory.SharedMemory = None
+        self.header: np.ndarray = None
+        self.frame: np.ndarray = None
+
+    def write(self, frame: Frame) -> None:
+        if self.memory is None:
+            self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=SHARED_HEADER_SIZE + frame.nbytes)
+            self.header = np.ndarray((4,), dtype=np.uint64, buffer=self.memory.buf)
+            self.frame = np.ndarray(frame.shape, dtype=np.uint8, buffer=self.memory.buf, offset=SHARED_HEADER_SIZE)
+            self.header[1:] = frame.shape
+        if frame.shape != self.frame.shape:
+            frame = cv2.resize(frame, (self.frame.shape[1], self.frame.shape[0]))
+        # an odd sequence tells readers the frame is being written
+        self.header[0] += 1
+        np.copyto(self.frame, frame)
+        self.header[0] += 1
+
+    def close(self) -> None:
+        if self.memory is not None:
+            self.header = self.frame = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+def read_shared_frame(memory: shared_memory.SharedMemory) -> Optional[Frame]:
+    """Copies the latest frame out of a block written by a SharedMemorySink, None before the first frame."""
+    header = np.ndarray((4,), dtype=np.uint64, buffer=memory.buf)
+    while True:
+        sequence = int(header[0])
+        if not sequence:
+            return None
+        if sequence % 2:
+            continue
+        frame = np.ndarray(tuple(int(size) for size in header[1:]), dtype=np.uint8, buffer=memory.buf, offset=SHARED_HEADER_SIZE).copy()
+        if int(header[0]) == sequence:
+            return frame
+
+
+class FfmpegSink:
+    """Pipes the frames into ffmpeg for recording to a file or streaming to a url."""
+
+    def __init__(self, output_path: str) -> None:
+        self.output_path = output_path
+        self.encoder: subprocess.Popen = None
+        self.frame_shape: Tuple[int, ...] = None
+
+    def write(self, frame: Frame) -> None:
+        if self.encoder is None:
+            self.frame_shape = frame.shape
+            output_format = next((['-f', output_format] for prefix, output_format in STREAM_FORMATS.items() if self.output_path.startswith(prefix)), [])
+            # frames arrive at the pace of the camera and inference, so they are timed by the wall clock
+            self.encoder = open_ffmpeg(['-use_wallclock_as_timestamps', '1', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{frame.shape[1]}x{frame.shape[0]}', '-i', '-',
+                                        '-c:v', modules.globals.video_encoder, '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-vsync', 'vfr'] + output_format + ['-y', self.output_path], stdin=subprocess.PIPE)
+        if frame.shape != self.frame_shape:
+            frame = cv2.resize(frame, (self.frame_shape[1], self.frame_shape[0]))
+        self.encoder.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self) -> None:
+        if self.encoder is not None:
+            self.encoder.stdin.close()
+            self.encoder.wait()
+            self.encoder = None
+
+
+class DisplaySink:
+    """Prepares frames for the preview window as PPM data Tk loads directly, without a round trip through PIL."""
+
+    def __init__(self) -> None:
+        self.data: bytes = None
+        self.lock = threading.Lock()
+
+    def write(self, frame: Frame) -> None:
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=BUFFER_POOL.like(frame))
+        # Tk only takes bytes, so the header and the pixels are joined in the one copy that cannot be avoided
+        data = f'P6 {rgb_frame.shape[1]} {rgb_frame.shape[0]} 255 '.encode() + memoryview(rgb_frame)
+        with self.lock:
+            self.data = data
+
+    def take(self) -> Optional[bytes]:
+        """Returns the latest prepared frame once."""
+        with self.lock:
+            data, self.data = self.data, None
+        return data
+
+    def close(self) -> None:
+        pass
+
+
+class SinkWorker:
+    """Feeds a sink from its own thread with the latest frame, older frames are dropped while the sink is busy."""
+
+    def __init__(self, sink: Any) -> None:
+        self.sink = sink
+        self.frame: Frame = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame: Frame) -> None:
+        with self.condition:
+            self.frame = frame
+            self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.frame is not None)
+                if self.frame is None:
+                    break
+                frame, self.frame = self.frame, None
+            try:
+                self.sink.write(frame)
+            except (OSError, ValueError) as exception:
+                print(f'[{NAME}] {type(self.sink).__name__} stopped: {exception}')
+                break
+        self.sink.close()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def create_sink(sink: str) -> Any:
+    """Creates a sink from shm:NAME or ffmpeg:PATH_OR_URL."""
+    kind, _, target = sink.partition(':')
+    if kind == 'shm':
+        return SharedMemorySink(target or 'deep-live-cam')
+    if kind == 'ffmpeg' and target:
+        return FfmpegSink(target)
+    raise ValueError(f'Unknown live sink {sink}')
+
+
+def open_sinks(sinks: List[Any]) -> List[SinkWorker]:
+    return [SinkWorker(sink) for sink in sinks]
+
+
+def publish(workers: List[SinkWorker], frame: Frame) -> None:
+    """Hands the frame to every sink, the caller must not modify it afterwards."""
+    for worker in workers:
+        worker.put(frame)
+
+
+def close_sinks(workers: List[SinkWorker]) -> None:
+    for worker in workers:
+        worker.close()
@@ -1,15 +1,22 @@
 import os
+import queue
+import threading
+import tkinter
 import webbrowser
 import customtkinter as ctk
-from typing import Callable, Tuple
+from typing import Callable, Optional, Tuple, Union
 import cv2
 from PIL import Image, ImageOps
 
 import modules.globals
 import modules.metadata
 from modules.face_analyser import get_one_face, get_unique_faces_from_target_image, get_unique_faces_from_target_video, add_blank_map, has_valid_map, simplify_maps
-from modules.capturer import get_video_frame, get_video_frame_total
+from modules.buffer_pool import BUFFER_POOL
+from modules.capturer import FrameCache, get_video_frame, get_video_frame_total, get_video_reader
+from modules.memory import register_release
+from modules.sinks import DisplaySink, create_sink, open_sinks, publish, close_sinks
 from modules.processors.frame.core import get_frame_processors_modules
+from modules.typing import Face, Frame
 from modules.utilities import is_image, is_video, resolve_relative_path, has_image_extension
 
 ROOT = None
@@ -34,6 +41,25 @@ POPUP_LIVE_HEIGHT = 820
 POPUP_LIVE_SCROLL_WIDTH = 890, 
 POPUP_LIVE_SCROLL_HEIGHT = 700
 
+# Number of processed preview frames kept for scrubbing back and forth
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_CACHE = FrameCache(PREVIEW_CACHE_SIZE)
+register_release(PREVIEW_CACHE.clear)
+# Settings a processed preview frame depends on
+PREVIEW_SETTINGS = ['source_path', 'target_path', 'frame_processors', 'fp_ui', 'many_faces', 'map_faces', 'color_correction', 'nsfw_filter']
+# Longest side of the draft rendered before the full resolution preview
+PREVIEW_DRAFT_SIZE = 480
+PREVIEW_POLL_INTERVAL = 30
+# Path and modification time of the source with the face detected in it, reused by every preview frame rendered
+PREVIEW_SOURCE_FACE: Tuple = (None, None)
+
+# Only the latest preview request is kept, older ones are stale and get cancelled
+PREVIEW_REQUEST = None
+PREVIEW_GENERATION = 0
+PREVIEW_CONDITION = threading.Condition()
+PREVIEW_RESULTS: queue.Queue = queue.Queue()
+PREVIEW_WORKER = None
+
 MAPPER_PREVIEW_MAX_HEIGHT = 100
 MAPPER_PREVIEW_MAX_WIDTH = 100
 
@@ -270,6 +296,7 @@ def create_preview(parent: ctk.CTkToplevel) -> ctk.CTkToplevel:
 
     preview_slider = ctk.CTkSlider(preview, from_=0, to=0, command=lambda frame_value: update_preview(frame_value))
 
+    preview.after(PREVIEW_POLL_INTERVAL, poll_preview)
     return preview
 
 
@@ -290,7 +317,7 @@ def update_tumbler(var: str, value: bool) -> None:
 def select_source_path() -> None:
     global RECENT_DIRECTORY_SOURCE, img_ft, vid_ft
 
-    PREVIEW.withdraw()
+    hide_preview()
     source_path = ctk.filedialog.askopenfilename(title='select an source image', initialdir=RECENT_DIRECTORY_SOURCE, filetypes=[img_ft])
     if is_image(source_path):
         modules.globals.source_path = source_path
@@ -317,7 +344,7 @@ def swap_faces_paths() -> None:
     RECENT_DIRECTORY_SOURCE = os.path.dirname(modules.globals.source_path)
     RECENT_DIRECTORY_TARGET = os.path.dirname(modules.globals.target_path)
 
-    PREVIEW.withdraw()
+    hide_preview()
 
     source_image = render_image_preview(modules.globals.source_path, (200, 200))
     source_label.configure(image=source_image)
@@ -329,7 +356,7 @@ def swap_faces_paths() -> None:
 def select_target_path() -> None:
     global RECENT_DIRECTORY_TARGET, img_ft, vid_ft
 
-    PREVIEW.withdraw()
+    hide_preview()
     target_path = ctk.filedialog.askopenfilename(title='select an target image or video', initialdir=RECENT_DIRECTORY_TARGET, filetypes=[img_ft, vid_ft])
     if is_image(target_path):
         modules.globals.target_path = target_path
@@ -361,17 +388,22 @@ def select_output_path(start: Callable[[], None]) -> None:
         start()
 
 
+def is_nsfw(target: Union[str, Frame]) -> bool:
+    from numpy import ndarray
+    from modules.predicter import predict_image, predict_video, predict_frame, get_cached_verdict
+    if type(target) is str: # image/video file path
+        check_nsfw = predict_image if has_image_extension(target) else predict_video
+    elif type(target) is ndarray: # frame object, skip the model when the whole target is known to be NSFW
+        target_nsfw = get_cached_verdict(modules.globals.target_path, 0 if has_image_extension(modules.globals.target_path) else modules.globals.nsfw_interval)
+        check_nsfw = (lambda _: True) if target_nsfw else predict_frame
+    return bool(check_nsfw and check_nsfw(target))
+
+
 def check_and_ignore_nsfw(target, destroy: Callable = None) -> bool:
     ''' Check if the target is NSFW.
     TODO: Consider to make blur the target.
     '''
-    from numpy import ndarray
-    from modules.predicter import predict_image, predict_video, predict_frame
-    if type(target) is str: # image/video file path
-        check_nsfw = predict_image if has_image_extension(target) else predict_video
-    elif type(target) is ndarray: # frame object
-        check_nsfw = predict_frame
-    if check_nsfw and check_nsfw(target):
+    if is_nsfw(target):
         if destroy: destroy(to_quit=False) # Do not need to destroy the window frame if the target is NSFW
         update_status('Processing ignored!')
         return True
@@ -390,7 +422,7 @@ def fit_image_to_size(image, width: int, height: int):
         ratio_w = width  / w
     ratio = max(ratio_w, ratio_h)
     new_size = (int(ratio * w), int(ratio * h))
-    return cv2.resize(image, dsize=new_size)
+    return cv2.resize(image, dsize=new_size, dst=BUFFER_POOL.get((new_size[1], new_size[0], image.shape[2]), image.dtype))
 
 
 def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage:
@@ -401,22 +433,17 @@ def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage
 
 
 def render_video_preview(video_path: str, size: Tuple[int, int], frame_number: int = 0) -> ctk.CTkImage:
-    capture = cv2.VideoCapture(video_path)
-    if frame_number:
-        capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    has_frame, frame = capture.read()
-    if has_frame:
+    frame = get_video_reader(video_path).read(frame_number)
+    if frame is not None:
         image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
         if size:
             image = ImageOps.fit(image, size, Image.LANCZOS)
         return ctk.CTkImage(image, size=image.size)
-    capture.release()
-    cv2.destroyAllWindows()
 
 
 def toggle_preview() -> None:
     if PREVIEW.state() == 'normal':
-        PREVIEW.withdraw()
+        hide_preview()
     elif modules.globals.source_path and modules.globals.target_path:
         init_preview()
         update_preview()
@@ -432,23 +459,122 @@ def init_preview() -> None:
         preview_slider.set(0)
 
 
+def get_preview_config() -> Tuple:
+    config = []
+    for name in PREVIEW_SETTINGS:
+        value = getattr(modules.globals, name)
+        config.append(tuple(sorted(value.items())) if isinstance(value, dict) else tuple(value) if isinstance(value, list) else value)
+    # a source image replaced on disk under the same name changes the result too
+    config.append(os.path.getmtime(modules.globals.source_path) if os.path.isfile(modules.globals.source_path) else None)
+    return tuple(config)
+
+
+def is_stale(generation: int) -> bool:
+    return generation != PREVIEW_GENERATION
+
+
+def process_preview_frame(source_face: Face, temp_frame: Frame, generation: int) -> Optional[Frame]:
+    """Runs the frame processors, returns None as soon as a newer preview is requested."""
+    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+        if is_stale(generation):
+            return None
+        temp_frame = frame_processor.process_frame(source_face, temp_frame)
+    return temp_frame
+
+
+def to_preview_image(temp_frame: Frame) -> Image.Image:
+    image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
+    return ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
+
+
+def get_source_face() -> Optional[Face]:
+    """Returns the face of the source image, detecting it again only once the source changed on disk."""
+    global PREVIEW_SOURCE_FACE
+
+    source_key = (modules.globals.source_path, os.path.getmtime(modules.globals.source_path) if os.path.isfile(modules.globals.source_path) else None)
+    if PREVIEW_SOURCE_FACE[0] != source_key:
+        PREVIEW_SOURCE_FACE = (source_key, get_one_face(cv2.imread(modules.globals.source_path)))
+    return PREVIEW_SOURCE_FACE[1]
+
+
+def render_preview(generation: int, frame_number: int) -> None:
+    """Renders a low resolution draft and then the full preview frame, posting both to the Tk thread."""
+    PREVIEW_CACHE.validate(get_preview_config())
+    image = PREVIEW_CACHE.get(frame_number)
+    if image is None:
+        temp_frame = get_video_frame(modules.globals.target_path, frame_number)
+        if temp_frame is None:
+            return
+        if modules.globals.nsfw_filter and is_nsfw(temp_frame):
+            PREVIEW_RESULTS.put((generation, None, 'Processing ignored!'))
+            return
+        source_face = get_source_face()
+        scale = PREVIEW_DRAFT_SIZE / max(temp_frame.shape[:2])
+        if scale < 1:
+            draft_frame = cv2.resize(temp_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            draft_frame = process_preview_frame(source_face, draft_frame, generation)
+            if draft_frame is None:
+                return
+            PREVIEW_RESULTS.put((generation, to_preview_image(draft_frame), 'Refining...'))
+        temp_frame = process_preview_frame(source_face, temp_frame, generation)
+        if temp_frame is None:
+            return
+        image = to_preview_image(temp_frame)
+        PREVIEW_CACHE.put(frame_number, image)
+    PREVIEW_RESULTS.put((generation, image, 'Processing succeed!'))
+
+
+def run_preview_worker() -> None:
+    global PREVIEW_REQUEST
+
+    while True:
+        with PREVIEW_CONDITION:
+            PREVIEW_CONDITION.wait_for(lambda: PREVIEW_REQUEST is not None)
+            generation, frame_number = PREVIEW_REQUEST
+            PREVIEW_REQUEST = None
+        try:
+            render_preview(generation, frame_number)
+        except Exception as exception:
+            PREVIEW_RESULTS.put((generation, None, f'Processing failed: {exception}'))
+
+
+def poll_preview() -> None:
+    """Shows the results of the preview worker that are still current, on the Tk thread."""
+    while True:
+        try:
+            generation, image, status = PREVIEW_RESULTS.get_nowait()
+        except queue.Empty:
+            break
+        if is_stale(generation):
+            continue
+        if image is not None:
+            preview_label.configure(image=ctk.CTkImage(image, size=image.size))
+            PREVIEW.deiconify()
+        update_status(status)
+    PREVIEW.after(PREVIEW_POLL_INTERVAL, poll_preview)
+
+
+def hide_preview() -> None:
+    """Withdraws the preview and cancels the frame being rendered for it."""
+    global PREVIEW_GENERATION
+
+    with PREVIEW_CONDITION:
+        PREVIEW_GENERATION += 1
+    PREVIEW.withdraw()
+
+
 def update_preview(frame_number: int = 0) -> None:
+    global PREVIEW_REQUEST, PREVIEW_GENERATION, PREVIEW_WORKER
+
     if modules.globals.source_path and modules.globals.target_path:
         update_status('Processing...')
-        temp_frame = get_video_frame(modules.globals.target_path, frame_number)
-        if modules.globals.nsfw_filter and check_and_ignore_nsfw(temp_frame):
-            return
-        for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-            temp_frame = frame_processor.process_frame(
-                get_one_face(cv2.imread(modules.globals.source_path)),
-                temp_frame
-            )
-        image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
-        image = ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
-        image = ctk.CTkImage(image, size=image.size)
-        preview_label.configure(image=image)
-        update_status('Processing succeed!')
-        PREVIEW.deiconify()
+        with PREVIEW_CONDITION:
+            PREVIEW_GENERATION += 1
+            PREVIEW_REQUEST = (PREVIEW_GENERATION, int(frame_number))
+            PREVIEW_CONDITION.notify()
+        if PREVIEW_WORKER is None:
+            PREVIEW_WORKER = threading.Thread(target=run_preview_worker, daemon=True)
+            PREVIEW_WORKER.start()
 
 def webcam_preview(root: ctk.CTk):
     if not modules.globals.map_faces:
@@ -476,15 +602,22 @@ def create_webcam_preview():
 
     source_image = None  # Initialize variable for the selected face image
 
+    # the sinks convert, share and encode the frames on their own threads
+    display_sink = DisplaySink()
+    sink_workers = open_sinks([display_sink] + [create_sink(sink) for sink in modules.globals.live_sinks])
+
+    frame = None
+
     while camera:
-        ret, frame = camera.read()
+        # frames are read into pooled buffers, a buffer is reused once the sinks are done with it
+        ret, frame = camera.read(BUFFER_POOL.like(frame) if frame is not None else None)
         if not ret:
             break
 
-        temp_frame = frame.copy()  #Create a copy of the frame
+        temp_frame = frame
 
         if modules.globals.live_mirror:
-            temp_frame = cv2.flip(temp_frame, 1) # horizontal flipping
+            temp_frame = cv2.flip(frame, 1, dst=BUFFER_POOL.like(frame)) # horizontal flipping
 
         if modules.globals.live_resizable:
             temp_frame = fit_image_to_size(temp_frame, PREVIEW.winfo_width(), PREVIEW.winfo_height())
@@ -502,17 +635,17 @@ def create_webcam_preview():
             for frame_processor in frame_processors:
                 temp_frame = frame_processor.process_frame_v2(temp_frame)
 
-        image = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)  # Convert the image to RGB format to display it with Tkinter
-        image = Image.fromarray(image)
-        image = ImageOps.contain(image, (temp_frame.shape[1], temp_frame.shape[0]), Image.LANCZOS)
-        image = ctk.CTkImage(image, size=image.size)
-        preview_label.configure(image=image)
+        publish(sink_workers, temp_frame)
+        data = display_sink.take()
+        if data:
+            preview_label.configure(image=tkinter.PhotoImage(data=data, format='PPM'))
         ROOT.update()
 
         if PREVIEW.state() == 'withdrawn':
             break
 
     camera.release()
+    close_sinks(sink_workers)
     PREVIEW.withdraw()  # Close preview window when loop is finished
 
 
@@ -1,7 +1,9 @@
-import glob, mimetypes, os, platform, shutil, ssl, subprocess, urllib, modules.globals
+import mimetypes, os, platform, shutil, ssl, subprocess, numpy as np, modules.globals
 from pathlib import Path
-from typing import List, Any
-from tqdm import tqdm
+from typing import List, Any, Tuple
+from modules.probe import probe
+from modules.model_registry import ensure_models
+from modules.frame_store import get_temp_frame_format, get_frame_name, get_frame_pattern, get_frame_paths, get_extract_args, read_frame, write_frame
 
 TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
@@ -19,14 +21,9 @@ def clean_temp(target_path: str) -> None:
     if os.path.exists(parent_directory_path) and not os.listdir(parent_directory_path):
         os.rmdir(parent_directory_path)
 
-def conditional_download(download_directory_path: str, urls: List[str]) -> None:
-    # """Download files if they do not exist in the directory."""
-    os.makedirs(download_directory_path, exist_ok=True)
-    for url in urls:
-        file_path = os.path.join(download_directory_path, os.path.basename(url))
-        if not os.path.exists(file_path):
-            with tqdm(total=int(urllib.request.urlopen(url).headers.get('Content-Length', 0)), desc='Downloading', unit='B', unit_scale=True, unit_divisor=1024) as progress:
-                urllib.request.urlretrieve(url, file_path, reporthook=lambda c, b, t: progress.update(b))  # type: ignore
+def conditional_download(download_directory_path: str, urls: List[str]) -> bool:
+    """Download files if they are missing or incomplete in the directory."""
+    return ensure_models(download_directory_path, urls)
 
 def create_temp(target_path: str) -> None:
     """Create a temporary directory."""
@@ -34,19 +31,69 @@ def create_temp(target_path: str) -> None:
 
 def create_video(target_path: str, fps: float = 30.0) -> None:
     """Create a video from extracted frames."""
-    run_ffmpeg(['-r', str(fps), '-i', os.path.join(get_temp_directory_path(target_path), '%04d.png'), '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', get_temp_output_path(target_path)])
+    output_args = get_encode_args(get_temp_output_path(target_path))
+    if get_temp_frame_format() == 'npy':
+        temp_frame_paths = get_temp_frame_paths(target_path)
+        if not temp_frame_paths:
+            return
+        height, width = read_frame(temp_frame_paths[0]).shape[:2]
+        process = open_ffmpeg(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-'] + output_args, stdin=subprocess.PIPE)
+        for temp_frame_path in temp_frame_paths:
+            process.stdin.write(np.ascontiguousarray(read_frame(temp_frame_path)).data)
+        process.stdin.close()
+        process.wait()
+        return
+    run_ffmpeg(['-r', str(fps), '-i', get_frame_pattern(get_temp_directory_path(target_path))] + output_args)
 
 def detect_fps(target_path: str) -> float:
     """Detect the frames per second (FPS) of a video."""
     try:
-        numerator, denominator = map(int, subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]).decode().strip().split('/'))
-        return numerator / denominator
+        return probe(target_path).fps
     except Exception:
         return 30.0
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    """Detect the width and height of a video."""
+    media_info = probe(target_path)
+    return media_info.width, media_info.height
+
+def detect_keyframes(target_path: str) -> Tuple[List[int], List[float]]:
+    """Detect the frame indices and timestamps of the keyframes of a video."""
+    media_info = probe(target_path)
+    if not media_info.keyframe_indices:
+        return [], []
+    return media_info.keyframe_indices + [media_info.frame_total], media_info.keyframe_times
+
+def has_audio(target_path: str) -> bool:
+    """Check whether the target has an audio stream to restore."""
+    try:
+        return probe(target_path).has_audio
+    except Exception:
+        return False
+
 def extract_frames(target_path: str) -> None:
     """Extract frames from a video."""
-    run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(get_temp_directory_path(target_path), '%04d.png')])
+    temp_directory_path = get_temp_directory_path(target_path)
+    if get_temp_frame_format() == 'npy':
+        width, height = detect_resolution(target_path)
+        frame_size = width * height * 3
+        process = open_ffmpeg(['-i', target_path, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=subprocess.PIPE)
+        index = 1
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            write_frame(os.path.join(temp_directory_path, get_frame_name(index)), np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3))
+            index += 1
+        process.wait()
+        return
+    run_ffmpeg(['-i', target_path] + get_extract_args(temp_directory_path))
+
+def get_encode_args(output_path: str, convert_colorspace: bool = True, repeat_headers: bool = False) -> List[str]:
+    """Get the FFmpeg output arguments for encoding processed frames, optionally keeping the colorspace of the decoded frames and repeating the parameter sets at every keyframe."""
+    colorspace_args = ['-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1'] if convert_colorspace else []
+    header_args = ['-x264-params', 'repeat-headers=1'] if repeat_headers and modules.globals.video_encoder == 'libx264' else []
+    return ['-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p'] + colorspace_args + header_args + ['-y', output_path]
 
 def get_temp_directory_path(target_path: str) -> str:
     """Get the path to the temporary directory for a video."""
@@ -54,7 +101,7 @@ def get_temp_directory_path(target_path: str) -> str:
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     """Get paths to temporary frames."""
-    return glob.glob(os.path.join(glob.escape(get_temp_directory_path(target_path)), '*.png'))
+    return get_frame_paths(get_temp_directory_path(target_path))
 
 def get_temp_output_path(target_path: str) -> str:
     """Get the path to the temporary output video file."""
@@ -64,6 +111,14 @@ def has_image_extension(image_path: str) -> bool:
     """Check if the file has an image extension."""
     return image_path.lower().endswith(('png', 'jpg', 'jpeg'))
 
+def get_image_paths(directory_path: str) -> List[str]:
+    """Get the paths of the images in a directory."""
+    return sorted(os.path.join(directory_path, name) for name in os.listdir(directory_path) if has_image_extension(name) and os.path.isfile(os.path.join(directory_path, name)))
+
+def is_image_directory(directory_path: str) -> bool:
+    """Check if the path is a directory containing images."""
+    return bool(directory_path and os.path.isdir(directory_path) and get_image_paths(directory_path))
+
 def is_image(image_path: str) -> bool:
     """Check if the file is an image based on MIME type."""
     return bool(image_path and os.path.isfile(image_path) and mimetypes.guess_type(image_path)[0].startswith('image/'))
@@ -82,7 +137,7 @@ def move_temp(target_path: str, output_path: str) -> None:
 
 def normalize_output_path(source_path: str, target_path: str, output_path: str) -> Any:
     """Normalize the output path for saving the result."""
-    if os.path.isdir(output_path):
+    if output_path and os.path.isdir(output_path) and not os.path.isdir(target_path or ''):
         source_name = os.path.splitext(os.path.basename(source_path))[0]
         target_name, target_extension = os.path.splitext(os.path.basename(target_path))
         return os.path.join(output_path, f"{source_name}-{target_name}{target_extension}")
@@ -94,9 +149,19 @@ def resolve_relative_path(path: str) -> str:
 
 def restore_audio(target_path: str, output_path: str) -> None:
     """Restore audio from the original video."""
-    if not run_ffmpeg(['-i', get_temp_output_path(target_path), '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path]):
+    if not mux_audio(get_temp_output_path(target_path), target_path, output_path):
         move_temp(target_path, output_path)
 
+def mux_audio(video_path: str, target_path: str, output_path: str) -> bool:
+    """Mux the video stream with the audio stream of the original video."""
+    if not has_audio(target_path):
+        return False
+    return run_ffmpeg(['-i', video_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
+
+def open_ffmpeg(args: List[str], **kwargs: Any) -> subprocess.Popen:
+    """Start an FFmpeg process with given arguments for piped input or output."""
+    return subprocess.Popen(['ffmpeg', '-hide_banner', '-hwaccel', 'auto', '-loglevel', modules.globals.log_level] + args, stderr=subprocess.DEVNULL, **kwargs)
+
 def run_ffmpeg(args: List[str]) -> bool:
     """Run an FFmpeg command with given arguments."""
     try:
@@ -0,0 +1,84 @@
+"""Downloads a generated model from local http.server stand-ins, one without byte ranges and one dropping ranged connections halfway.
+
+usage: python scripts/check_downloads.py
+"""
+import functools, hashlib, http.server, os, shutil, sys, tempfile, threading
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.model_registry import DownloadError, download_model
+
+# Small enough that the generated file is fetched in parallel byte ranges
+SPLIT_SIZE = 1024 * 1024
+
+
+class PlainHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves whole files only, like servers without range support."""
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class RangeHandler(PlainHandler):
+    """Serves byte ranges, the first request of every range loses its connection halfway."""
+    dropped: set = set()
+
+    def do_GET(self) -> None:
+        byte_range = self.headers.get('Range')
+        file_path = self.translate_path(self.path)
+        if not byte_range or not os.path.isfile(file_path):
+            return super().do_GET()
+        size = os.path.getsize(file_path)
+        start, _, end = byte_range[6:].partition('-')
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(file_path, 'rb') as file:
+            file.seek(start)
+            body = file.read(end - start + 1)
+        # the size probe asks for a single byte and is always served
+        if end > start and end not in RangeHandler.dropped:
+            RangeHandler.dropped.add(end)
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    def handle_error(self, *args: Any) -> None:
+        # the size probe hangs up on full responses
+        pass
+
+
+def check_download(directory_path: str, handler: Any, content: bytes) -> bool:
+    server = Server(('127.0.0.1', 0), functools.partial(handler, directory=directory_path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    file_path = os.path.join(directory_path, f'{handler.__name__}.onnx')
+    try:
+        download_model(f'http://127.0.0.1:{server.server_address[1]}/served.onnx', file_path, hashlib.sha256(content).hexdigest(), SPLIT_SIZE)
+        with open(file_path, 'rb') as file:
+            return file.read() == content
+    except DownloadError as exception:
+        print(exception)
+        return False
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    directory_path = tempfile.mkdtemp(prefix='dlc-models-')
+    content = os.urandom(3 * SPLIT_SIZE + 123)
+    with open(os.path.join(directory_path, 'served.onnx'), 'wb') as file:
+        file.write(content)
+    try:
+        results = {'without byte ranges': check_download(directory_path, PlainHandler, content),
+                   'with dropped ranged connections': check_download(directory_path, RangeHandler, content)}
+    finally:
+        shutil.rmtree(directory_path, ignore_errors=True)
+    for name, result in results.items():
+        print(f"{name}: {'ok' if result else 'failed'}")
+    sys.exit(0 if all(results.values()) else 1)
@@ -0,0 +1,120 @@
+"""Races worker processes for the shards of a job, with a temp directory standing in for the shared filesystem.
+
+usage: python scripts/check_shards.py
+"""
+import multiprocessing, os, shutil, sys, tempfile, threading, time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modules.shards as shards
+
+WORKER_TOTAL = 4
+SHARD_TOTAL = 32
+
+
+def claim_all(shard_dir: str, barrier: Any) -> None:
+    """Claims what it can and records every claim, the way run_worker walks the pending shards."""
+    barrier.wait()
+    for index in range(SHARD_TOTAL):
+        if shards.claim_shard(shard_dir, index):
+            with open(os.path.join(shard_dir, f'{index:04d}.claims'), 'a') as file:
+                file.write(f'{os.getpid()}\n')
+
+
+def fail_all(shard_dir: str, barrier: Any) -> None:
+    barrier.wait()
+    for index in range(SHARD_TOTAL):
+        shards.record_failure(shard_dir, index)
+
+
+def race(shard_dir: str, target: Any) -> None:
+    barrier = multiprocessing.Barrier(WORKER_TOTAL)
+    workers = [multiprocessing.Process(target=target, args=(shard_dir, barrier)) for _ in range(WORKER_TOTAL)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def count_claims(shard_dir: str) -> List[int]:
+    counts = []
+    for index in range(SHARD_TOTAL):
+        try:
+            with open(os.path.join(shard_dir, f'{index:04d}.claims')) as file:
+                counts.append(len(file.readlines()))
+        except OSError:
+            counts.append(0)
+    return counts
+
+
+def make_shard_dir(directory_path: str, name: str) -> str:
+    shard_dir = os.path.join(directory_path, name)
+    os.makedirs(os.path.join(shard_dir, shards.SHARD_DIRECTORY))
+    os.makedirs(os.path.join(shard_dir, shards.LOCK_DIRECTORY))
+    return shard_dir
+
+
+def check_claims(directory_path: str) -> bool:
+    """Every shard is claimed by exactly one worker."""
+    shard_dir = make_shard_dir(directory_path, 'claims')
+    race(shard_dir, claim_all)
+    return count_claims(shard_dir) == [1] * SHARD_TOTAL
+
+
+def check_stale_claims(directory_path: str) -> bool:
+    """Every stale lock is reclaimed by exactly one worker, live locks are left alone."""
+    shard_dir = make_shard_dir(directory_path, 'stale')
+    stale_time = time.time() - shards.SHARD_LOCK_TIMEOUT - 60
+    for index in range(SHARD_TOTAL):
+        lock_path = shards.get_lock_path(shard_dir, index)
+        with open(lock_path, 'w') as file:
+            file.write('dead-host 1\n')
+        if index % 2 == 0:
+            os.utime(lock_path, (stale_time, stale_time))
+    race(shard_dir, claim_all)
+    return count_claims(shard_dir) == [1, 0] * (SHARD_TOTAL // 2)
+
+
+def check_failures(directory_path: str) -> bool:
+    """Failures recorded at the same time by all workers are all counted."""
+    shard_dir = make_shard_dir(directory_path, 'failures')
+    race(shard_dir, fail_all)
+    return all(shards.get_failure_count(shard_dir, index) == WORKER_TOTAL for index in range(SHARD_TOTAL))
+
+
+def check_heartbeat(directory_path: str) -> bool:
+    """The heartbeat outlives a lock that is briefly gone and refreshes it once it is back."""
+    shard_dir = make_shard_dir(directory_path, 'heartbeat')
+    lock_path = shards.get_lock_path(shard_dir, 0)
+    heartbeat_interval = shards.SHARD_HEARTBEAT_INTERVAL
+    shards.SHARD_HEARTBEAT_INTERVAL = 0.05
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=shards.keep_alive, args=(lock_path, stop_event), daemon=True)
+    heartbeat.start()
+    try:
+        time.sleep(0.2)
+        with open(lock_path, 'w') as file:
+            file.write(f'{os.getpid()}\n')
+        stale_time = time.time() - shards.SHARD_LOCK_TIMEOUT - 60
+        os.utime(lock_path, (stale_time, stale_time))
+        time.sleep(0.2)
+        return heartbeat.is_alive() and time.time() - os.path.getmtime(lock_path) < shards.SHARD_LOCK_TIMEOUT
+    finally:
+        stop_event.set()
+        heartbeat.join()
+        shards.SHARD_HEARTBEAT_INTERVAL = heartbeat_interval
+
+
+if __name__ == '__main__':
+    directory_path = tempfile.mkdtemp(prefix='dlc-shards-')
+    try:
+        results: Dict[str, bool] = {'exclusive claims': check_claims(directory_path),
+                                    'stale lock claims': check_stale_claims(directory_path),
+                                    'concurrent failures': check_failures(directory_path),
+                                    'heartbeat without lock': check_heartbeat(directory_path)}
+    finally:
+        shutil.rmtree(directory_path, ignore_errors=True)
+    for name, result in results.items():
+        print(f"{name}: {'ok' if result else 'failed'}")
+    sys.exit(0 if all(results.values()) else 1)